@@ -114,6 +114,10 @@ DATABASES = {
         "PASSWORD": PG_PASSWORD,
         "HOST": PG_URL,
         "PORT": "5432",
+        # Request and search threads reuse their SSL connections instead of
+        # opening one per request
+        "CONN_MAX_AGE": 600,
+        "CONN_HEALTH_CHECKS": True,
         "OPTIONS": {
             "sslmode": "require",
             "options": f"endpoint={PG_ENDPOINT}",
@@ -121,6 +125,39 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # State every gunicorn worker must agree on (catalog version, per user
+    # counters and caches invalidated by writes), in the database since the
+    # default cache is per process. The table is created by a songs migration.
+    # A handful of entries per user, so the cap only culls well past the user
+    # base; a full cache drops its expired entries, then a tenth of the rest
+    "shared": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "shared_cache",
+        "OPTIONS": {
+            "MAX_ENTRIES": 200000,
+            "CULL_FREQUENCY": 10,
+        },
+    },
+    # Spotify search results. Culling 1/MAX_ENTRIES of a full cache evicts
+    # exactly the least recently used entry
+    "spotify_search": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "spotify-search",
+        "TIMEOUT": 10 * 60,
+        "OPTIONS": {
+            "MAX_ENTRIES": 1000,
+            "CULL_FREQUENCY": 1000,
+        },
+    },
+}
+
+# Offline recommendation models, e.g. the item neighbours written by build_item_neighbours
+RECOMMENDER_MODEL_DIR = os.getenv("RECOMMENDER_MODEL_DIR", str(BASE_DIR / "recommender"))
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
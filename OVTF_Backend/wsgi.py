@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'OVTF_Backend.settings')
 
 application = get_wsgi_application()
+
+# Builds the in-process autocomplete indexes in the background, before the
+# first lookups need them
+from songs.autocomplete import warmAutocomplete  # noqa: E402
+
+warmAutocomplete()
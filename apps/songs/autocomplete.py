@@ -0,0 +1,145 @@
+import heapq
+import logging
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection
+
+from songs.models import Artist, Genre, Song
+
+# Seconds between two watermark checks against the database. Lookups in
+# between are served from memory only
+AUTOCOMPLETE_REFRESH_SECONDS = 30
+# updated_at is set when a row is saved, not when its transaction commits,
+# so rows saved up to this long before the watermark are read again
+AUTOCOMPLETE_WATERMARK_MARGIN = timedelta(minutes=5)
+AUTOCOMPLETE_RESULTS = 10
+# Refreshes run here, lookups meanwhile are served from the current lists
+AUTOCOMPLETE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='autocomplete')
+
+
+def normalizeName(name: str):
+    # Case and accent insensitive form of a name, e.g. 'Sezen Aksu' and 'sézen aksu' match
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    return ' '.join(''.join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def nameKeys(name: str):
+    # One key per word start so that 'aksu' finds 'Sezen Aksu' as well
+    normalized = normalizeName(name)
+    return [normalized[i:] for i in range(len(normalized)) if i == 0 or normalized[i - 1] == ' ']
+
+
+class PrefixIndex:
+    # In-process prefix index over the `name` column of a CoreModel. The keys
+    # are kept sorted with the row ids in a parallel list and looked up with a
+    # binary search. Rows changed since the `updated_at` watermark are merged
+    # in by refresh(); readers always see a consistent (keys, ids) pair
+    def __init__(self, model):
+        self.model = model
+        self.entries = ([], [])
+        self.names = {}
+        self.watermark = None
+        self.merged = set()
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.entries = ([], [])
+            self.names = {}
+            self.watermark = None
+            self.merged = set()
+            self.checked_at = None
+
+    def refresh(self):
+        rows = self.model.all_objects.order_by()
+        if self.watermark is not None:
+            # Rows committed after the watermark moved past them are within
+            # the margin
+            rows = rows.filter(updated_at__gte=self.watermark - AUTOCOMPLETE_WATERMARK_MARGIN)
+        rows = list(rows.values_list('id', 'name', 'updated_at', 'is_active', 'is_deleted'))
+        # Only the rows not merged yet in this version cost a rebuild of the lists
+        merged = self.merged
+        rows = [row for row in rows if (row[0], row[2]) not in merged]
+        if not rows:
+            return
+        changed_ids = {row_id for row_id, *_ in rows}
+        names = {row_id: name for row_id, name in self.names.items() if row_id not in changed_ids}
+        added = []
+        for row_id, name, updated_at, is_active, is_deleted in rows:
+            if is_active and not is_deleted:
+                names[row_id] = name
+                added.extend((key, row_id) for key in nameKeys(name))
+            if updated_at is not None and (self.watermark is None or updated_at > self.watermark):
+                self.watermark = updated_at
+        keys, ids = self.entries
+        kept = ((key, row_id) for key, row_id in zip(keys, ids) if row_id not in changed_ids)
+        entries = list(heapq.merge(kept, sorted(added)))
+        self.entries = ([key for key, _ in entries], [row_id for _, row_id in entries])
+        self.names = names
+        if self.watermark is not None:
+            margin_start = self.watermark - AUTOCOMPLETE_WATERMARK_MARGIN
+            self.merged = {pair for pair in merged if pair[1] >= margin_start} | {
+                (row_id, updated_at) for row_id, _, updated_at, *_ in rows
+                if updated_at is not None and updated_at >= margin_start}
+
+    def refreshIfStale(self):
+        # Never waits: a stale index is refreshed by an AUTOCOMPLETE_EXECUTOR
+        # thread unless one already is
+        if self.checked_at is not None and time.monotonic() - self.checked_at < AUTOCOMPLETE_REFRESH_SECONDS:
+            return
+        if self.lock.acquire(blocking=False):
+            AUTOCOMPLETE_EXECUTOR.submit(self.refreshLocked)
+
+    def refreshLocked(self):
+        # Runs with the lock refreshIfStale acquired, on its own database connection
+        try:
+            self.refresh()
+        except Exception:
+            logging.exception(f"Refreshing the {self.model.__name__} autocomplete index failed")
+        finally:
+            self.checked_at = time.monotonic()
+            self.lock.release()
+            connection.close()
+
+    def search(self, prefix: str, number_of_results=AUTOCOMPLETE_RESULTS):
+        prefix = normalizeName(prefix)
+        keys, ids = self.entries
+        names = self.names
+        results, seen = [], set()
+        if not prefix:
+            return results
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and len(results) < number_of_results and keys[i].startswith(prefix):
+            if ids[i] not in seen and ids[i] in names:
+                seen.add(ids[i])
+                results.append({'id': ids[i], 'name': names[ids[i]]})
+            i += 1
+        return results
+
+
+AUTOCOMPLETE_INDEXES = {
+    'artists': PrefixIndex(Artist),
+    'genres': PrefixIndex(Genre),
+    'songs': PrefixIndex(Song),
+}
+
+
+def warmAutocomplete():
+    # Called when a web worker starts so the first lookups do not find empty indexes
+    for index in AUTOCOMPLETE_INDEXES.values():
+        index.refreshIfStale()
+
+
+def autocomplete(prefix: str, number_of_results=AUTOCOMPLETE_RESULTS):
+    # Artists, genres and songs whose name (or a word of it) starts with prefix
+    results = {}
+    for kind, index in AUTOCOMPLETE_INDEXES.items():
+        index.refreshIfStale()
+        results[kind] = index.search(prefix, number_of_results)
+    return results
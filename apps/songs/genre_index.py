@@ -0,0 +1,214 @@
+import logging
+import random
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+from songs.models import Genre, GenreSong
+
+# Seconds between two checks for genre links added by other processes
+GENRE_INDEX_REFRESH_SECONDS = 60
+# Link ids come from a sequence, so a link may commit after one with a
+# higher id; every check reads again this many ids below the highest seen
+GENRE_INDEX_RESCAN_LINKS = 1000
+# Seconds between two full rebuilds, which drop the songs deleted or
+# deactivated since and pick up links committed later than the rescan.
+# They run on GENRE_INDEX_EXECUTOR and hold the lock for a chunk of links
+# at a time, lookups meanwhile use the current arrays
+GENRE_INDEX_REBUILD_SECONDS = 60 * 60
+GENRE_INDEX_REBUILD_CHUNK = 10000
+GENRE_INDEX_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='genre-index')
+# A genre name the index does not know re-reads the genres at most this often
+GENRE_INDEX_MISS_SECONDS = 10
+
+
+class GenreSongIndex:
+    # In-process genre -> song index for random sampling. Every song id is
+    # stored once in song_ids; a genre holds the positions of its songs in an
+    # unsigned int array, so a big genre costs 4 bytes per song rather than a
+    # Python object. linked_songs holds the positions of the songs with at
+    # least one genre, for sampling the whole catalog. Links are read
+    # incrementally from a little below the last seen GenreSong id, appending
+    # never moves an existing position so readers need no lock. A rebuild
+    # swaps in new genre arrays but keeps the positions of the songs
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Held for a whole rebuild, so only one runs at a time
+        self.rebuild_lock = threading.Lock()
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        # Positions handed out before are void, generation tells users of them
+        self.generation += 1
+        self.song_ids = []
+        self.positions = {}
+        self.genre_songs = {}
+        self.linked = bytearray()
+        self.linked_songs = array('I')
+        self.genre_ids = {}
+        self.genres_read_at = None
+        self.last_link_id = 0
+        self.recent_links = set()
+        self.checked_at = None
+        self.built_at = None
+        self.rebuilding = False
+
+    def readGenres(self):
+        self.genre_ids = {name.lower(): genre_id for genre_id, name in Genre.objects.values_list('id', 'name')}
+        self.genres_read_at = time.monotonic()
+
+    def addLink(self, genre_songs, linked, linked_songs, genre_id, song_id):
+        # Called with the lock held
+        position = self.positions.get(song_id)
+        if position is None:
+            position = self.positions[song_id] = len(self.song_ids)
+            self.song_ids.append(song_id)
+        genre_songs.setdefault(genre_id, array('I')).append(position)
+        if position >= len(linked):
+            linked.extend(bytes(max(position + 1 - len(linked), len(linked) // 2)))
+        if not linked[position]:
+            linked[position] = 1
+            linked_songs.append(position)
+
+    def links(self, after: int):
+        return (GenreSong.objects.filter(id__gt=after, song__is_active=True, song__is_deleted=False)
+                .order_by('id').values_list('id', 'genre_id', 'song_id'))
+
+    def refresh(self, rebuild=False):
+        # Reads the links added since the last check, or all of them when
+        # rebuild is given or the index was never built
+        if rebuild or self.built_at is None:
+            self.rebuild()
+            return
+        with self.lock:
+            self.refreshLocked()
+
+    def refreshLocked(self):
+        self.readGenres()
+        read_links = deque(maxlen=GENRE_INDEX_RESCAN_LINKS)
+        last_link_id = self.last_link_id
+        for link_id, genre_id, song_id in self.links(last_link_id - GENRE_INDEX_RESCAN_LINKS).iterator():
+            if link_id in self.recent_links:
+                continue
+            self.addLink(self.genre_songs, self.linked, self.linked_songs, genre_id, song_id)
+            read_links.append(link_id)
+            last_link_id = max(last_link_id, link_id)
+        # The links that the next rescan reads again and must skip
+        self.recent_links = {link_id for link_id in (*self.recent_links, *read_links)
+                             if link_id > last_link_id - GENRE_INDEX_RESCAN_LINKS}
+        self.last_link_id = last_link_id
+        self.checked_at = time.monotonic()
+
+    def rebuild(self):
+        with self.rebuild_lock:
+            self.rebuildLocked()
+
+    def rebuildLocked(self):
+        # New genre arrays from every link of an active song, swapped in at
+        # the end. The positions of the songs are kept
+        started_at = time.monotonic()
+        genre_songs, linked, linked_songs = {}, bytearray(len(self.song_ids)), array('I')
+        read_links, chunk = deque(maxlen=GENRE_INDEX_RESCAN_LINKS), []
+        for link in self.links(0).iterator(chunk_size=GENRE_INDEX_REBUILD_CHUNK):
+            chunk.append(link)
+            if len(chunk) == GENRE_INDEX_REBUILD_CHUNK:
+                self.addLinks(chunk, genre_songs, linked, linked_songs, read_links)
+                chunk = []
+        self.addLinks(chunk, genre_songs, linked, linked_songs, read_links)
+        with self.lock:
+            self.readGenres()
+            self.genre_songs = genre_songs
+            self.linked, self.linked_songs = linked, linked_songs
+            self.last_link_id = read_links[-1] if read_links else 0
+            self.recent_links = set(read_links)
+            self.checked_at = self.built_at = started_at
+
+    def addLinks(self, links, genre_songs, linked, linked_songs, read_links):
+        with self.lock:
+            for link_id, genre_id, song_id in links:
+                self.addLink(genre_songs, linked, linked_songs, genre_id, song_id)
+                read_links.append(link_id)
+
+    def rebuildInBackground(self):
+        # Runs on GENRE_INDEX_EXECUTOR, which has its own database connection
+        try:
+            self.rebuild()
+        except Exception:
+            logging.exception("Rebuilding the genre index failed")
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    def refreshIfStale(self):
+        now = time.monotonic()
+        if (self.built_at is not None and not self.rebuilding
+                and now - self.built_at >= GENRE_INDEX_REBUILD_SECONDS):
+            self.rebuilding = True
+            GENRE_INDEX_EXECUTOR.submit(self.rebuildInBackground)
+        if self.checked_at is not None and now - self.checked_at < GENRE_INDEX_REFRESH_SECONDS:
+            return
+        if self.built_at is None:
+            # Nothing to serve yet, the first caller builds and the others wait for it
+            with self.rebuild_lock:
+                if self.built_at is None:
+                    self.rebuildLocked()
+            return
+        with self.lock:
+            # Another thread may have refreshed while this one waited
+            if self.checked_at is None or time.monotonic() - self.checked_at >= GENRE_INDEX_REFRESH_SECONDS:
+                self.refreshLocked()
+
+    def refreshIfBuilt(self):
+        # Called after songs are ingested, a not yet built index reads them when it is built
+        if self.checked_at is not None:
+            self.refresh()
+
+    def songPositions(self, song_ids):
+        # Dense positions of song ids, usable as bit indexes. Songs the index
+        # does not hold yet (e.g. songs without genres) are given one
+        with self.lock:
+            positions = []
+            for song_id in song_ids:
+                position = self.positions.get(song_id)
+                if position is None:
+                    position = self.positions[song_id] = len(self.song_ids)
+                    self.song_ids.append(song_id)
+                positions.append(position)
+            return positions
+
+    def genreId(self, name: str):
+        # Case insensitive like name__iexact. The genre may have been created
+        # by another process, so a miss re-reads the genre names, unless they
+        # were read less than GENRE_INDEX_MISS_SECONDS ago
+        self.refreshIfStale()
+        genre_id = self.genre_ids.get(name.lower())
+        if genre_id is None and time.monotonic() - self.genres_read_at >= GENRE_INDEX_MISS_SECONDS:
+            with self.lock:
+                if time.monotonic() - self.genres_read_at >= GENRE_INDEX_MISS_SECONDS:
+                    self.readGenres()
+            genre_id = self.genre_ids.get(name.lower())
+        return genre_id
+
+    def sample(self, genre_id: int, k: int):
+        # Up to k distinct random song ids of the genre in O(k)
+        self.refreshIfStale()
+        positions = self.genre_songs.get(genre_id)
+        if not positions:
+            return []
+        picks = random.sample(range(len(positions)), min(k, len(positions)))
+        return [self.song_ids[positions[i]] for i in picks]
+
+    def sampleSongs(self, k: int):
+        # Up to k distinct random song ids out of all the songs with a genre in O(k)
+        self.refreshIfStale()
+        positions = self.linked_songs
+        picks = random.sample(range(len(positions)), min(k, len(positions)))
+        return [self.song_ids[positions[i]] for i in picks]
+
+
+GENRE_SONG_INDEX = GenreSongIndex()
@@ -0,0 +1,236 @@
+import json
+import os
+import statistics
+import sys
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from songs import views
+from songs.models import Album, Artist, Genre, Song
+from songs.utils import (searchNames, searchSongs, trigramThreshold,
+                         SONG_SIMILARITY_THRESHOLD, NAME_SIMILARITY_THRESHOLD, SEARCH_PAGE_SIZE)
+
+SYLLABLES = [consonant + vowel for consonant in 'bcdfghjklmnprstvyz' for vowel in 'aeiou']
+BENCHMARK_DATA = '{"benchmark": true}'
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+# Queries that do not depend on the generated names, next to the ones sample_terms picks
+FIXED_TERMS = [('short prefix', 'ka'), ('two syllables', 'Bado'), ('no match', 'xqzw qzxw')]
+# view name -> (view, search parameter, extra parameters)
+SEARCH_VIEWS = {
+    'search_db': (views.search_db, 'search_string', {'number_of_songs': SEARCH_PAGE_SIZE}),
+    'search_artists': (views.search_artists, 'search_text', {'number_of_artists': 10}),
+    'search_genres': (views.search_genres, 'search_text', {'number_of_genres': 10}),
+}
+
+
+def word_sql(seed: str, salt: str):
+    # A pseudo random three syllable word, deterministic for the row `seed`
+    syllables = 'ARRAY[' + ', '.join(f"'{syllable}'" for syllable in SYLLABLES) + ']'
+    parts = [f"({syllables})[1 + abs(hashtext({seed}::text || '{salt}{i}')) % {len(SYLLABLES)}]"
+             for i in range(3)]
+    return ' || '.join(parts)
+
+
+def name_sql(seed: str, salt: str):
+    return f"initcap({word_sql(seed, salt + 'a')} || ' ' || {word_sql(seed, salt + 'b')})"
+
+
+def skewed_sql(seed: str, salt: str, n: int):
+    # 1..n with a long tail: the first rows get most of the picks, like popular artists do
+    return f"1 + floor({n} * power(abs(hashtext({seed}::text || '{salt}')) / 2147483648.0, 3))::int"
+
+
+def create_catalog(number_of_songs: int):
+    # Every song has one album (about 10 songs per album), a skewed main
+    # artist plus a featured artist on every fifth song, and one to three genres
+    number_of_artists = max(number_of_songs // 10, 1)
+    number_of_albums = max(number_of_songs // 10, 1)
+    number_of_genres = min(max(number_of_songs // 2000, 10), 500)
+    core = f"now(), true, false, '{BENCHMARK_DATA}'::jsonb"
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO songs_artist (id, name, bio, created_at, is_active, is_deleted, data)
+            SELECT 'bench-artist-' || i, {name_sql('i', 'artist')}, '', {core}
+            FROM generate_series(1, {number_of_artists}) AS i""")
+        cursor.execute(f"""
+            INSERT INTO songs_album (id, name, release_year, created_at, is_active, is_deleted, data)
+            SELECT 'bench-album-' || i, {name_sql('i', 'album')}, 1960 + i % 64, {core}
+            FROM generate_series(1, {number_of_albums}) AS i""")
+        cursor.execute(f"""
+            INSERT INTO songs_genre (name, song_count, created_at, is_active, is_deleted, data)
+            SELECT initcap({word_sql('i', 'genre')}) || ' ' || i, 0, {core}
+            FROM generate_series(1, {number_of_genres}) AS i""")
+        cursor.execute(f"""
+            INSERT INTO songs_song (id, name, release_year, duration, tempo, mood, recorded_environment,
+                                    replay_count, img_url, created_at, is_active, is_deleted, data)
+            SELECT 'bench-song-' || i, {name_sql('i', 'song')}, 1960 + i % 64, interval '3 minutes',
+                   (ARRAY['S', 'M', 'F'])[1 + i % 3], (ARRAY['H', 'SA', 'E', 'R'])[1 + i % 4],
+                   (ARRAY['I', 'O', 'S', 'L'])[1 + i % 4], 0, 'https://img.example.com/' || i, {core}
+            FROM generate_series(1, {number_of_songs}) AS i""")
+        cursor.execute(f"""
+            INSERT INTO songs_artistsong (song_id, artist_id, created_at, is_active, is_deleted, data)
+            SELECT DISTINCT ON (song_id, artist_id) song_id, artist_id, {core}
+            FROM (SELECT 'bench-song-' || i AS song_id,
+                         'bench-artist-' || {skewed_sql('i', 'artist', number_of_artists)} AS artist_id
+                  FROM generate_series(1, {number_of_songs}) AS i
+                  UNION ALL
+                  SELECT 'bench-song-' || i, 'bench-artist-' || {skewed_sql('i', 'feat', number_of_artists)}
+                  FROM generate_series(5, {number_of_songs}, 5) AS i) AS links""")
+        cursor.execute(f"""
+            INSERT INTO songs_albumsong (song_id, album_id, created_at, is_active, is_deleted, data)
+            SELECT 'bench-song-' || i, 'bench-album-' || (1 + (i - 1) / 10 % {number_of_albums}), {core}
+            FROM generate_series(1, {number_of_songs}) AS i""")
+        cursor.execute(f"""
+            INSERT INTO songs_genresong (song_id, genre_id, created_at, is_active, is_deleted, data)
+            SELECT DISTINCT ON (song_id, genre_id) song_id, genre_id, {core}
+            FROM (SELECT 'bench-song-' || i AS song_id,
+                         genres.ids[{skewed_sql('i || g', 'genre', number_of_genres)}] AS genre_id
+                  FROM generate_series(1, {number_of_songs}) AS i,
+                       generate_series(1, 3) AS g,
+                       (SELECT array_agg(id ORDER BY id) AS ids FROM songs_genre WHERE data ? 'benchmark') AS genres
+                  WHERE g <= 1 + i % 3) AS links""")
+    # Fresh tables have no statistics yet, which would plan the refresh updates as nested loops
+    analyze_catalog()
+    Song.refresh_search_documents(Song.all_objects.filter(data__benchmark=True).values('id'))
+    Genre.refresh_stats(Genre.all_objects.filter(data__benchmark=True).values('id'))
+    analyze_catalog()
+    return {'songs': number_of_songs, 'artists': number_of_artists,
+            'albums': number_of_albums, 'genres': number_of_genres}
+
+
+def analyze_catalog():
+    with connection.cursor() as cursor:
+        for table in ('songs_song', 'songs_artist', 'songs_album', 'songs_genre',
+                      'songs_artistsong', 'songs_albumsong', 'songs_genresong'):
+            cursor.execute(f'ANALYZE {table}')
+
+
+def sample_terms():
+    # Deterministic for a catalog size, since the names are hashes of the row numbers
+    artist = Artist.all_objects.filter(data__benchmark=True).order_by('id').first().name
+    song = Song.all_objects.filter(data__benchmark=True).order_by('id').first().name
+    genre = Genre.all_objects.filter(data__benchmark=True).order_by('id').first().name
+    misspelled = artist[:2] + artist[3:]
+    return [
+        ('artist name', artist),
+        ('misspelled artist', misspelled),
+        ('song word', song.split()[0]),
+        ('genre word', genre.split()[0]),
+    ] + FIXED_TERMS
+
+
+def plan_summary(plan):
+    # Index names, sequentially scanned relations and rows read by the scans
+    # of an EXPLAIN (ANALYZE, FORMAT JSON) plan
+    indexes, seq_scans, rows_scanned = set(), set(), 0
+    nodes = [plan['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if 'Index Name' in node:
+            indexes.add(node['Index Name'])
+        if node['Node Type'] == 'Seq Scan':
+            seq_scans.add(node['Relation Name'])
+        if 'Scan' in node['Node Type'] and node['Node Type'] != 'Bitmap Index Scan':
+            rows = (node['Actual Rows'] + node.get('Rows Removed by Filter', 0)
+                    + node.get('Rows Removed by Index Recheck', 0))
+            rows_scanned += round(rows * node['Actual Loops'])
+        nodes.extend(node.get('Plans', []))
+    return sorted(indexes), sorted(seq_scans), rows_scanned, plan['Execution Time']
+
+
+def explain(queryset):
+    return plan_summary(json.loads(queryset.explain(format='json', analyze=True))[0])
+
+
+def search_queries(term):
+    return {
+        'search_db': (SONG_SIMILARITY_THRESHOLD, searchSongs(term)[:SEARCH_PAGE_SIZE + 1]),
+        'search_artists': (NAME_SIMILARITY_THRESHOLD, searchNames(Artist, term)[:10]),
+        'search_genres': (NAME_SIMILARITY_THRESHOLD, searchNames(Genre, term)[:10]),
+    }
+
+
+def percentiles(latencies):
+    if len(latencies) == 1:
+        return {'p50_ms': latencies[0], 'p95_ms': latencies[0], 'p99_ms': latencies[0]}
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    return {'p50_ms': round(cuts[49], 3), 'p95_ms': round(cuts[94], 3), 'p99_ms': round(cuts[98], 3)}
+
+
+def call_view(view, params, token):
+    # Through the real view, with the search result cache cleared so every
+    # call reaches the database
+    request = RequestFactory().get('/', params, HTTP_AUTHORIZATION=f'Bearer {token}')
+    cache.clear()
+    started_at = time.perf_counter()
+    response = view(request)
+    elapsed = (time.perf_counter() - started_at) * 1000
+    if response.status_code != 200:
+        raise CommandError(f'{view.__name__} answered {response.status_code} for {params}')
+    return elapsed
+
+
+def benchmark_size(number_of_songs, repeat, token, log):
+    started_at = time.perf_counter()
+    catalog = create_catalog(number_of_songs)
+    catalog['build_seconds'] = round(time.perf_counter() - started_at, 1)
+    log(f"{number_of_songs} songs: catalog built in {catalog['build_seconds']} s")
+    results, latencies_by_view = [], {name: [] for name in SEARCH_VIEWS}
+    for label, term in sample_terms():
+        queries = search_queries(term)
+        for name, (view, search_param, extra) in SEARCH_VIEWS.items():
+            params = {search_param: term, **extra}
+            call_view(view, params, token)
+            latencies = [call_view(view, params, token) for _ in range(repeat)]
+            with CaptureQueriesContext(connection) as ctx:
+                call_view(view, params, token)
+            threshold, queryset = queries[name]
+            with trigramThreshold(threshold):
+                indexes, seq_scans, rows_scanned, execution_time = explain(queryset)
+            latencies_by_view[name] += latencies
+            result = {'view': name, 'label': label, 'term': term, **percentiles(latencies),
+                      'queries': len(ctx.captured_queries), 'rows_scanned': rows_scanned,
+                      'execution_ms': round(execution_time, 3), 'indexes': indexes, 'seq_scans': seq_scans}
+            results.append(result)
+            log(f"  {name:<15} {label:<18} p50={result['p50_ms']:>8.2f} ms  p99={result['p99_ms']:>8.2f} ms  "
+                f"queries={result['queries']}  rows_scanned={rows_scanned}  seq_scans={','.join(seq_scans) or '-'}")
+    summary = {name: percentiles(latencies) for name, latencies in latencies_by_view.items()}
+    return {'catalog': catalog, 'views': summary, 'queries': results}
+
+
+class Command(BaseCommand):
+    help = ('Builds synthetic catalogs of each size, runs a fixed corpus of queries through the search '
+            'views and reports p50/p95/p99 latency, query count and rows scanned (EXPLAIN ANALYZE) as JSON. '
+            'The catalogs are rolled back unless --keep is given. Needs USER_TEST_TOKEN.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                            default=DEFAULT_SIZES, help='Comma separated catalog sizes in songs')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed calls per view and query')
+        parser.add_argument('--output', default='-', help='JSON report file, - for stdout')
+        parser.add_argument('--keep', action='store_true', help='Keep the (single) generated catalog')
+
+    def handle(self, *args, **options):
+        token = os.getenv('USER_TEST_TOKEN')
+        if not token:
+            raise CommandError('USER_TEST_TOKEN must be set to call the views')
+        if options['keep'] and len(options['sizes']) > 1:
+            raise CommandError('--keep needs a single size')
+        log = (lambda line: self.stderr.write(line)) if options['output'] == '-' else self.stdout.write
+        report = {'repeat': options['repeat'], 'sizes': []}
+        for number_of_songs in options['sizes']:
+            with transaction.atomic():
+                report['sizes'].append(benchmark_size(number_of_songs, options['repeat'], token, log))
+                if not options['keep']:
+                    transaction.set_rollback(True)
+        if options['output'] == '-':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
@@ -0,0 +1,71 @@
+import math
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+
+from songs.models import Genre, GenreSong, Song
+from songs.song_features import FEATURE_GENRES, appendSongs, buildAdded, encodeSongs, saveSongFeatures
+
+
+def read_songs(genre_ids, only=None):
+    # Sorted song ids (of all songs or of the only ones) with their (tempo, mood,
+    # recorded_environment, release_year) and their genre ids among genre_ids
+    rows = Song.objects.order_by().values_list('id', 'tempo', 'mood', 'recorded_environment', 'release_year')
+    links = GenreSong.objects.filter(genre_id__in=genre_ids).order_by().values_list('song_id', 'genre_id')
+    if only is not None:
+        rows, links = rows.filter(id__in=only), links.filter(song_id__in=only)
+    songs = {song_id: fields for song_id, *fields in rows.iterator(chunk_size=10_000)}
+    song_genres = {}
+    for song_id, genre_id in links.iterator(chunk_size=10_000):
+        song_genres.setdefault(song_id, []).append(genre_id)
+    song_ids = sorted(songs, key=str.encode)
+    return (song_ids, [songs[song_id] for song_id in song_ids],
+            [song_genres.get(song_id, []) for song_id in song_ids])
+
+
+def load_songs(number_of_genres: int):
+    # read_songs of every song, restricted to the number_of_genres biggest genres
+    genre_ids = list(Genre.objects.order_by('-song_count', 'id').values_list('id', flat=True)[:number_of_genres])
+    return (*read_songs(genre_ids), genre_ids)
+
+
+class Command(BaseCommand):
+    help = ('Encodes every song as a content feature vector (tempo, mood, recorded environment, release year '
+            'and genres), clusters the vectors into the inverted lists of the similarity index and saves both '
+            'as memory mapped .npy files used by the recommendations.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--genres', type=int, default=FEATURE_GENRES,
+                            help='Number of biggest genres that get a feature column')
+        parser.add_argument('--lists', type=int, default=None,
+                            help='Inverted lists of the similarity index, defaults to the square root of the songs')
+        parser.add_argument('--output', default=None,
+                            help=f'Model directory, defaults to RECOMMENDER_MODEL_DIR ({settings.RECOMMENDER_MODEL_DIR})')
+
+    def handle(self, *args, **options):
+        if options['genres'] < 0:
+            raise CommandError('--genres must not be negative')
+        if options['lists'] is not None and options['lists'] < 1:
+            raise CommandError('--lists must be positive')
+        started = time.monotonic()
+        song_ids, songs, song_genres, genre_ids = load_songs(options['genres'])
+        if not song_ids:
+            raise CommandError('There are no songs to encode')
+        years = Song.objects.aggregate(first=Min('release_year'), last=Max('release_year'))
+        year_range = (years['first'] or 0, years['last'] or 0)
+        features = encodeSongs(songs, song_genres, genre_ids, year_range)
+        number_of_lists = options['lists'] or max(1, math.isqrt(len(song_ids)))
+        missed = saveSongFeatures(np.array([song_id.encode() for song_id in song_ids], dtype=bytes), features,
+                                  genre_ids, year_range, number_of_lists, options['output'])
+        # Songs ingested while the catalog was read went to the previous build
+        missed_ids, missed_songs, missed_genres = read_songs(genre_ids, missed) if missed else ([], [], [])
+        if missed_ids:
+            path, record_type = buildAdded(options['output'])
+            appendSongs(path, record_type, missed_ids,
+                        encodeSongs(missed_songs, missed_genres, genre_ids, year_range))
+        self.stdout.write(f'Saved {features.shape[1]} features of {len(song_ids)} songs in '
+                          f'{min(number_of_lists, len(song_ids))} lists in {time.monotonic() - started:.1f}s, '
+                          f'{len(missed_ids)} songs ingested meanwhile appended')
@@ -0,0 +1,43 @@
+# Generated by Django 5.0.3 on 2026-10-18 10:45
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_genre_stats(apps, schema_editor):
+    Genre = apps.get_model('songs', 'Genre')
+    GenreSong = apps.get_model('songs', 'GenreSong')
+    genre_songs = GenreSong.objects.filter(genre=OuterRef('pk'),
+                                           is_deleted=False, is_active=True,
+                                           song__is_deleted=False, song__is_active=True)
+    song_count = genre_songs.order_by().values('genre').annotate(count=Count('id')).values('count')
+    cover = genre_songs.order_by('-created_at').values('song__img_url')[:1]
+    Genre.objects.update(song_count=Coalesce(Subquery(song_count), 0),
+                         cover_img_url=Subquery(cover))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0015_playlist_playlistsong_playlist_songs_and_more'),
+        ('users', '0016_suggestionnotification_suggestion_receiver_seen_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genre',
+            name='cover_img_url',
+            field=models.URLField(blank=True, max_length=1000, null=True),
+        ),
+        migrations.AddField(
+            model_name='genre',
+            name='song_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=models.Index(fields=['-song_count', 'id'], name='genre_song_count'),
+        ),
+        migrations.RunPython(backfill_genre_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.0.3 on 2026-10-18 10:48
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_search_documents(apps, schema_editor):
+    Song = apps.get_model('songs', 'Song')
+    ArtistSong = apps.get_model('songs', 'ArtistSong')
+    AlbumSong = apps.get_model('songs', 'AlbumSong')
+    artist_names = ArtistSong.objects.filter(song=OuterRef('pk')).order_by() \
+        .values('song').annotate(names=StringAgg('artist__name', ' ')).values('names')
+    album_names = AlbumSong.objects.filter(song=OuterRef('pk')).order_by() \
+        .values('song').annotate(names=StringAgg('album__name', ' ')).values('names')
+    Song.objects.update(search_document=(
+        SearchVector('name', weight='A') +
+        SearchVector(Coalesce(Subquery(artist_names), Value(''), output_field=TextField()), weight='B') +
+        SearchVector(Coalesce(Subquery(album_names), Value(''), output_field=TextField()), weight='C')
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0016_genre_cover_img_url_genre_song_count_and_more'),
+        ('users', '0016_suggestionnotification_suggestion_receiver_seen_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='search_document',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_document'], name='song_search_document'),
+        ),
+        migrations.RunPython(backfill_search_documents, migrations.RunPython.noop),
+    ]
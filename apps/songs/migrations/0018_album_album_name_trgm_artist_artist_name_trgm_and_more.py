@@ -0,0 +1,33 @@
+# Generated by Django 5.0.3 on 2026-10-18 10:50
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0017_song_search_document_song_song_search_document'),
+        ('users', '0016_suggestionnotification_suggestion_receiver_seen_and_more'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='album',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='album_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='artist',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='artist_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='genre',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='genre_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['name'], name='song_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
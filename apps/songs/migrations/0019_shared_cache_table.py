@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_table(apps, schema_editor):
+    call_command('createcachetable', database=schema_editor.connection.alias, verbosity=0)
+
+
+def drop_cache_table(apps, schema_editor):
+    schema_editor.execute(f'DROP TABLE IF EXISTS "{settings.CACHES["shared"]["LOCATION"]}"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0018_album_album_name_trgm_artist_artist_name_trgm_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, drop_cache_table),
+    ]
@@ -0,0 +1,14 @@
+from django.contrib.postgres.operations import CreateExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0019_shared_cache_table'),
+    ]
+
+    operations = [
+        # TABLESAMPLE SYSTEM_ROWS for songs.utils.randomSample
+        CreateExtension('tsm_system_rows'),
+    ]
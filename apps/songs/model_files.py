@@ -0,0 +1,63 @@
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+
+def modelPath(prefix: str, name: str, directory=None, extension='npy'):
+    return os.path.join(directory or settings.RECOMMENDER_MODEL_DIR, f'{prefix}_{name}.{extension}')
+
+
+def saveModelArrays(prefix: str, arrays: dict, directory=None):
+    # One .npy file per array. Every file is written aside and renamed so
+    # serving processes never read a half written model; the first array goes
+    # last since its modification time marks the model as new
+    directory = directory or settings.RECOMMENDER_MODEL_DIR
+    os.makedirs(directory, exist_ok=True)
+    for name in reversed(list(arrays)):
+        path = modelPath(prefix, name, directory)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, arrays[name])
+        os.replace(path + '.tmp', path)
+
+
+class MappedModel:
+    # Arrays saved by saveModelArrays, memory mapped so a model is shared
+    # between the worker processes through the page cache and loading it
+    # costs no parsing. A rebuilt model is picked up on the next load()
+    def __init__(self, prefix: str, names):
+        self.prefix = prefix
+        self.names = tuple(names)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.arrays = None
+        self.version = None
+
+    def load(self):
+        # The arrays by name, None when the model was never built
+        path = modelPath(self.prefix, self.names[0])
+        try:
+            version = (path, os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            self.reset()
+            return None
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.arrays = {name: np.load(modelPath(self.prefix, name), mmap_mode='r')
+                                   for name in self.names}
+                    self.version = version
+        return self.arrays
+
+
+def songPositions(song_ids, seeds):
+    # Positions of seeds in the sorted byte string array song_ids and a mask
+    # of the seeds that were found
+    seeds = np.array([seed.encode() for seed in seeds], dtype=bytes)
+    if not len(song_ids) or not len(seeds):
+        return np.zeros(len(seeds), dtype=np.intp), np.zeros(len(seeds), dtype=bool)
+    positions = np.minimum(np.searchsorted(song_ids, seeds), len(song_ids) - 1)
+    return positions, song_ids[positions] == seeds
@@ -1,4 +1,8 @@
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.db.models.functions import Coalesce
 
 from OVTF_Backend.models import CoreModel
 
@@ -32,10 +36,35 @@ class Genre(CoreModel):
     name = models.CharField(unique=True,
                             max_length=100)
     img_url = models.URLField(max_length=1000, blank=True, null=True)
+    # Maintained by refresh_stats whenever songs are ingested or removed
+    song_count = models.PositiveIntegerField(default=0)
+    cover_img_url = models.URLField(max_length=1000, blank=True, null=True)
+
+    class Meta(CoreModel.Meta):
+        indexes = [
+            models.Index(fields=['-song_count', 'id'], name='genre_song_count'),
+            GinIndex(fields=['name'], name='genre_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return str(self.name)
 
+    @classmethod
+    def refresh_stats(cls, genre_ids):
+        # Recomputes song_count and cover_img_url (image of the latest song)
+        # of the given genres in a single UPDATE. Counts the same links as
+        # the 0016 backfill: live links of live songs
+        genre_songs = GenreSong.all_objects.filter(genre=models.OuterRef('pk'),
+                                                   is_deleted=False, is_active=True,
+                                                   song__is_deleted=False, song__is_active=True)
+        song_count = genre_songs.order_by().values('genre') \
+            .annotate(count=models.Count('id')).values('count')
+        cover = genre_songs.order_by('-created_at').values('song__img_url')[:1]
+        cls.all_objects.filter(id__in=genre_ids).update(
+            song_count=Coalesce(models.Subquery(song_count), 0),
+            cover_img_url=models.Subquery(cover),
+        )
+
 
 class Song(CoreModel):
     id = models.CharField(default=uuid.uuid4,
@@ -57,10 +86,58 @@ class Song(CoreModel):
     version = models.CharField(max_length=50,
                                blank=True, null=True,)
     img_url = models.URLField(max_length=1000, blank=True, null=True)
+    # Song, artist and album names, maintained by refresh_search_documents
+    search_document = SearchVectorField(null=True, editable=False)
+
+    class Meta(CoreModel.Meta):
+        indexes = [
+            GinIndex(fields=['search_document'], name='song_search_document'),
+            GinIndex(fields=['name'], name='song_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return str(self.name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        song = super().from_db(db, field_names, values)
+        # The stored name, save() only rebuilds the search document when it changes
+        song.stored_name = values[field_names.index('name')] if 'name' in field_names else None
+        return song
+
+    def save(self, *args, **kwargs):
+        # Artist and album changes refresh the document where they are written
+        update_fields = kwargs.get('update_fields')
+        refresh = ((self._state.adding or getattr(self, 'stored_name', None) != self.name)
+                   and (update_fields is None or 'name' in update_fields))
+        super().save(*args, **kwargs)
+        if refresh:
+            Song.refresh_search_documents([self.pk])
+            self.stored_name = self.name
+
+    def delete(self):
+        genre_ids = list(self.genres.values_list('id', flat=True))
+        super().delete()
+        Genre.refresh_stats(genre_ids)
+
+    @classmethod
+    def refresh_search_documents(cls, song_ids):
+        # Rebuilds the search document of the given songs in a single UPDATE,
+        # song names weigh more than artist names, which weigh more than albums
+        artist_names = ArtistSong.objects.filter(song=models.OuterRef('pk')).order_by() \
+            .values('song').annotate(names=StringAgg('artist__name', ' ')).values('names')
+        album_names = AlbumSong.objects.filter(song=models.OuterRef('pk')).order_by() \
+            .values('song').annotate(names=StringAgg('album__name', ' ')).values('names')
+        artist_names = Coalesce(models.Subquery(artist_names), models.Value(''),
+                                output_field=models.TextField())
+        album_names = Coalesce(models.Subquery(album_names), models.Value(''),
+                               output_field=models.TextField())
+        cls.all_objects.filter(id__in=song_ids).update(search_document=(
+            SearchVector('name', weight='A') +
+            SearchVector(artist_names, weight='B') +
+            SearchVector(album_names, weight='C')
+        ))
+
 
 class Artist(CoreModel):
     id = models.CharField(max_length=1000,
@@ -69,9 +146,21 @@ class Artist(CoreModel):
     bio = models.TextField()
     img_url = models.URLField(max_length=1000, blank=True, null=True)
 
+    class Meta(CoreModel.Meta):
+        indexes = [
+            GinIndex(fields=['name'], name='artist_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
     def __str__(self):
         return str(self.name)
 
+    def save(self, *args, **kwargs):
+        renamed = not self._state.adding and \
+            Artist.all_objects.filter(id=self.id).exclude(name=self.name).exists()
+        super().save(*args, **kwargs)
+        if renamed:
+            Song.refresh_search_documents(self.song_set.values('id'))
+
 
 class Album(CoreModel):
     id = models.CharField(max_length=1000, primary_key=True)
@@ -79,9 +168,21 @@ class Album(CoreModel):
     release_year = models.PositiveIntegerField(blank=True)
     img_url = models.URLField(max_length=1000, blank=True, null=True)
 
+    class Meta(CoreModel.Meta):
+        indexes = [
+            GinIndex(fields=['name'], name='album_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
     def __str__(self):
         return str(self.name)
 
+    def save(self, *args, **kwargs):
+        renamed = not self._state.adding and \
+            Album.all_objects.filter(id=self.id).exclude(name=self.name).exists()
+        super().save(*args, **kwargs)
+        if renamed:
+            Song.refresh_search_documents(self.song_set.values('id'))
+
 
 class Instrument(CoreModel):
     id = models.AutoField(primary_key=True)
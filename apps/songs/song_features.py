@@ -0,0 +1,278 @@
+import glob
+import math
+import os
+
+import numpy as np
+
+from songs.model_files import MappedModel, modelPath, saveModelArrays, songPositions
+from songs.models import Mood, RecordedEnvironment, Tempo
+
+# Genres with the most songs get a column each, the rest are left out
+FEATURE_GENRES = 128
+# Songs come as (tempo, mood, recorded_environment, release_year) tuples
+FEATURE_CATEGORIES = [('tempo', Tempo.values), ('mood', Mood.values),
+                      ('recorded_environment', RecordedEnvironment.values)]
+# Weight of each block in the cosine similarity of two songs
+FEATURE_WEIGHTS = {'tempo': 1.0, 'mood': 1.0, 'recorded_environment': 0.5, 'release_year': 1.0, 'genres': 2.0}
+# A similarity search scores the songs of the SIMILAR_PROBES lists whose
+# centroids are closest to the taste; more probes trade latency for recall
+SIMILAR_PROBES = 16
+# k-means of the lists runs on up to LIST_TRAINING_SONGS songs per list
+LIST_TRAINING_SONGS = 64
+LIST_TRAINING_ITERATIONS = 10
+# Song ids of inserted songs are stored in at least this many bytes
+ADDED_ID_BYTES = 64
+
+
+def featureSize(number_of_genres: int):
+    return sum(len(values) for _, values in FEATURE_CATEGORIES) + 2 + number_of_genres
+
+
+def encodeSongs(songs, song_genres, genre_ids, year_range):
+    # Unit length float32 feature rows: one-hot tempo, mood and environment,
+    # the release year as a point on a quarter circle so the similarity of
+    # two years falls with their distance, and multi-hot genre_ids scaled so
+    # the genre block has the same weight for any number of genres
+    features = np.zeros((len(songs), featureSize(len(genre_ids))), dtype=np.float32)
+    column = 0
+    for field, (name, values) in enumerate(FEATURE_CATEGORIES):
+        codes = {value: i for i, value in enumerate(values)}
+        for row, song in enumerate(songs):
+            if song[field] in codes:
+                features[row, column + codes[song[field]]] = FEATURE_WEIGHTS[name]
+        column += len(values)
+
+    first, last = year_range
+    years = np.array([song[3] or first for song in songs], dtype=np.float32)
+    angles = np.clip((years - first) / max(last - first, 1), 0, 1) * (math.pi / 2)
+    features[:, column] = np.cos(angles) * FEATURE_WEIGHTS['release_year']
+    features[:, column + 1] = np.sin(angles) * FEATURE_WEIGHTS['release_year']
+    column += 2
+
+    genre_columns = {genre_id: column + i for i, genre_id in enumerate(genre_ids)}
+    for row, genres in enumerate(song_genres):
+        columns = [genre_columns[genre_id] for genre_id in genres if genre_id in genre_columns]
+        if columns:
+            features[row, columns] = FEATURE_WEIGHTS['genres'] / math.sqrt(len(columns))
+
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    return features
+
+
+def nearestLists(features, centroids):
+    # Index of the closest centroid of every row, a block of rows at a time
+    block_size = max(1, 2 ** 24 // len(centroids))
+    return np.concatenate([np.argmax(features[start:start + block_size] @ centroids.T, axis=1)
+                           for start in range(0, len(features), block_size)])
+
+
+def trainLists(features, number_of_lists: int, seed=0):
+    # Inverted lists for the similarity search: spherical k-means centroids
+    # trained on a sample, then every song assigned to its closest centroid.
+    # Returns the centroids and the song positions grouped by list, list i
+    # being positions[offsets[i]:offsets[i + 1]]
+    rng = np.random.default_rng(seed)
+    number_of_lists = max(1, min(number_of_lists, len(features)))
+    sample_size = min(len(features), number_of_lists * LIST_TRAINING_SONGS)
+    sample = features[np.sort(rng.choice(len(features), sample_size, replace=False))]
+    centroids = sample[rng.choice(sample_size, number_of_lists, replace=False)].copy()
+    for _ in range(LIST_TRAINING_ITERATIONS):
+        assignment = nearestLists(sample, centroids)
+        order = np.argsort(assignment, kind='stable')
+        lists, starts = np.unique(assignment[order], return_index=True)
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        # A list that lost all its songs keeps its centroid
+        centroids[lists] = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    assignment = nearestLists(features, centroids)
+    positions = np.argsort(assignment, kind='stable').astype(np.int32)
+    offsets = np.searchsorted(assignment[positions], np.arange(number_of_lists + 1)).astype(np.int64)
+    return centroids, offsets, positions
+
+
+def addedPath(version, directory=None):
+    # Songs inserted after a build are appended to a file of that build
+    return modelPath('song', f'added_{version}', directory, extension='bin')
+
+
+def addedType(ids, features):
+    # Record of an inserted song in the file of the build with these arrays
+    return np.dtype([('id', f'S{max(ids.dtype.itemsize, ADDED_ID_BYTES)}'),
+                     ('features', np.float32, features.shape[1])])
+
+
+def appendSongs(path, record_type, song_ids, features):
+    # With a single write, so appends of several processes do not interleave
+    records = np.zeros(len(song_ids), dtype=record_type)
+    records['id'] = [song_id.encode() for song_id in song_ids]
+    records['features'] = features
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, records.tobytes())
+    finally:
+        os.close(fd)
+
+
+def buildAdded(directory=None):
+    # Path and record type of the songs inserted into the current build, None without a build
+    try:
+        path = addedPath(os.stat(modelPath('song', 'ids', directory)).st_mtime_ns, directory)
+        return path, addedType(np.load(modelPath('song', 'ids', directory), mmap_mode='r'),
+                               np.load(modelPath('song', 'features', directory), mmap_mode='r'))
+    except FileNotFoundError:
+        return None
+
+
+def saveSongFeatures(song_ids, features, genre_ids, year_range, number_of_lists: int, directory=None):
+    # song_ids must be sorted, features[i] is the row of song_ids[i]. Songs
+    # inserted into earlier builds are dropped, this build encoded them again
+    # from the database. Returns the ids of the songs inserted into the
+    # previous build that this one lacks, they were ingested while it read
+    # the catalog and have to be appended to it with appendSongs
+    previous = buildAdded(directory)
+    features = features.astype(np.float32)
+    centroids, offsets, positions = trainLists(features, number_of_lists)
+    saveModelArrays('song', {'ids': song_ids,
+                             'features': features,
+                             'genre_ids': np.asarray(genre_ids, dtype=np.int32),
+                             'year_range': np.asarray(year_range, dtype=np.int32),
+                             'centroids': centroids,
+                             'list_offsets': offsets,
+                             'list_positions': positions}, directory)
+    missed = []
+    if previous is not None and os.path.exists(previous[0]):
+        path, record_type = previous
+        added_ids = np.fromfile(path, dtype=record_type, count=os.path.getsize(path) // record_type.itemsize)['id']
+        missed = [song_id.decode() for song_id in dict.fromkeys(added_ids[~np.isin(added_ids, song_ids)])]
+    current = addedPath(os.stat(modelPath('song', 'ids', directory)).st_mtime_ns, directory)
+    for path in glob.glob(addedPath('*', directory)):
+        if path != current:
+            os.remove(path)
+    return missed
+
+
+class SongFeatures:
+    # Content feature matrix of the catalog built by build_song_features,
+    # memory mapped. Rows have unit length so a matrix-vector product gives
+    # the cosine similarity of songs to a seed or taste vector. Searches go
+    # through an inverted file index and only score the songs of the lists
+    # closest to the taste. Songs ingested since the build are appended to a
+    # file of the build that every process maps as well and scans in full
+    def __init__(self):
+        self.model = MappedModel('song', ('ids', 'features', 'genre_ids', 'year_range',
+                                          'centroids', 'list_offsets', 'list_positions'))
+        self.added_songs = None
+
+    def reset(self):
+        self.model.reset()
+        self.added_songs = None
+
+    def added(self, model):
+        # Songs inserted into the loaded build, as a record array
+        path = addedPath(self.model.version[1])
+        record_type = addedType(model['ids'], model['features'])
+        try:
+            count = os.stat(path).st_size // record_type.itemsize
+        except FileNotFoundError:
+            count = 0
+        if self.added_songs is None or self.added_songs[0] != (path, count):
+            records = (np.memmap(path, dtype=record_type, mode='r', shape=(count,)) if count
+                       else np.zeros(0, dtype=record_type))
+            self.added_songs = ((path, count), records)
+        return self.added_songs[1]
+
+    def insert(self, song_id: str, song, genre_ids):
+        # Makes a song ingested after the build searchable; song is a
+        # (tempo, mood, recorded_environment, release_year) tuple
+        model = self.model.load()
+        if model is None:
+            return False
+        record_type = addedType(model['ids'], model['features'])
+        if len(song_id.encode()) > record_type['id'].itemsize:
+            return False
+        appendSongs(addedPath(self.model.version[1]), record_type, [song_id],
+                    encodeSongs([song], [genre_ids], model['genre_ids'].tolist(),
+                                tuple(model['year_range'].tolist())))
+        return True
+
+    def vectors(self, model, song_ids):
+        # Feature rows of song_ids and a mask of the ones that were found
+        positions, known = songPositions(model['ids'], song_ids)
+        vectors = np.zeros((len(song_ids), model['features'].shape[1]), dtype=np.float32)
+        vectors[known] = model['features'][positions[known]]
+        added = self.added(model)
+        for i in np.flatnonzero(~known) if len(added) else []:
+            rows = np.flatnonzero(added['id'] == song_ids[i].encode())
+            if len(rows):
+                vectors[i], known[i] = added['features'][rows[-1]], True
+        return vectors, known
+
+    def tasteVector(self, ratings):
+        # Rating weighted mean of the features of the rated songs, as a unit
+        # vector. ratings is a list of (song_id, rating); None when no model
+        # was built or none of the songs is in it
+        model = self.model.load()
+        if model is None or not ratings:
+            return None
+        vectors, known = self.vectors(model, [song_id for song_id, _ in ratings])
+        if not known.any():
+            return None
+        weights = np.array([float(rating) for _, rating in ratings], dtype=np.float32)
+        taste = weights[known] @ vectors[known]
+        norm = np.linalg.norm(taste)
+        return taste / norm if norm > 0 else None
+
+    def candidates(self, model, taste, probes: int):
+        # Positions of the songs of the probes lists closest to taste, sorted
+        # so rows are read in file order; None when every list is probed
+        centroids = model['centroids']
+        if probes >= len(centroids):
+            return None
+        lists = np.argpartition(-(centroids @ taste), probes - 1)[:probes]
+        offsets, positions = model['list_offsets'], model['list_positions']
+        return np.sort(np.concatenate([positions[offsets[i]:offsets[i + 1]] for i in lists]))
+
+    def similar(self, taste, k: int, exclude=(), probes=SIMILAR_PROBES):
+        # The k song ids most similar to taste, skipping the exclude ids.
+        # Exact when probes covers all lists
+        model = self.model.load()
+        if model is None or taste is None:
+            return None
+        excluded, known = songPositions(model['ids'], list(exclude))
+        positions = self.candidates(model, taste, max(probes, 1))
+        if positions is None:
+            positions = np.arange(len(model['ids']))
+            scores = model['features'] @ taste
+            scores[excluded[known]] = -np.inf
+        else:
+            scores = model['features'][positions] @ taste
+            scores[np.isin(positions, excluded[known])] = -np.inf
+        added = self.added(model)
+        if len(added):
+            added_scores = added['features'] @ taste
+            added_scores[np.isin(added['id'], np.array([song_id.encode() for song_id in exclude], dtype=bytes))] = -np.inf
+            scores = np.concatenate([scores, added_scores])
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(model['ids'][positions[i]] if i < len(positions) else added['id'][i - len(positions)]).decode()
+                for i in top]
+
+    def recommend(self, ratings, k: int, probes=SIMILAR_PROBES):
+        # Up to k song ids closest to the taste of ratings, excluding the rated songs
+        return self.similar(self.tasteVector(ratings), k, exclude=[song_id for song_id, _ in ratings],
+                            probes=probes)
+
+    def rank(self, song_ids, taste):
+        # song_ids ordered by similarity to taste, songs without features last
+        model = self.model.load()
+        if model is None or taste is None or not song_ids:
+            return list(song_ids)
+        vectors, known = self.vectors(model, song_ids)
+        scores = np.full(len(song_ids), -np.inf, dtype=np.float32)
+        scores[known] = vectors[known] @ taste
+        return [song_ids[i] for i in np.argsort(-scores, kind='stable')]
+
+
+SONG_FEATURES = SongFeatures()
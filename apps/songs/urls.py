@@ -5,6 +5,7 @@ from songs import views
 urlpatterns = [
  path('get-all/', view=views.get_all_songs, name='get-all-songs'),
  path('search-db/', views.search_db, name='search-db'),
+ path('search/', views.search, name='search'),
  path('get-song-by-id/', views.get_song_by_id, name='get-song-by-id'),
  path('add-song/', views.add_song, name='add-song'),
  path('search-spotify/', views.search_spotify, name='search-spotify'),
@@ -17,6 +18,8 @@ urlpatterns = [
  path('get-random-genres/', views.get_random_genres, name='get-random-genres'),
  path('search-artists/', views.search_artists, name='search-artists'),
  path('search-genres/', views.search_genres, name='search_genres'),
+ path('autocomplete/', views.autocomplete_names, name='autocomplete'),
+ path('similar-songs/', views.similar_songs, name='similar-songs'),
  path('get-all-moods/', views.get_all_moods, name='get_all_moods'),
  path('get-all-tempos/', views.get_all_tempos, name='get_all_tempos'),
  path('get-banger-songs/', views.get_banger_songs, name='get_banger_songs')
@@ -1,7 +1,21 @@
+import base64
+import hashlib
+import json
+import logging
 import random
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from datetime import datetime
 from typing import Tuple, List
-from django.db.models import Model, Count, Sum
+from django.contrib.postgres.expressions import ArraySubquery
+from django.contrib.postgres.lookups import TrigramSimilar
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.core.cache import cache, caches
+from django.db.models import (Model, Count, Sum, QuerySet, F, FloatField, OuterRef, Q, Window,
+                              prefetch_related_objects)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, RowNumber
 import requests
 from bs4 import BeautifulSoup
 import os
@@ -12,7 +26,11 @@ from songs.models import (Album, Artist,
                           Genre, Mood,
                           RecordedEnvironment,
                           Song, Tempo,
-                          Instrument, Playlist,)
+                          Instrument, Playlist, PlaylistSong,
+                          ArtistSong, AlbumSong,)
+
+from songs.genre_index import GENRE_SONG_INDEX
+from songs.song_features import SONG_FEATURES
 
 from spotipy.oauth2 import SpotifyClientCredentials
 
@@ -20,8 +38,316 @@ from spotipy.exceptions import SpotifyException
 
 from datetime import timedelta
 
+from django.db import close_old_connections, connection, transaction
 from django.http import JsonResponse
 
+# Minimum pg_trgm similarity for fuzzy song matches and for artist/genre names
+SONG_SIMILARITY_THRESHOLD = 0.4
+NAME_SIMILARITY_THRESHOLD = 0.2
+SEARCH_PAGE_SIZE = 20
+# Most results a search endpoint returns per section or page
+SEARCH_MAX_RESULTS = 100
+
+
+def encodeCursor(value, row_id):
+    # Opaque keyset cursor for the (value, id) of the last row of a page
+    value = value.isoformat() if isinstance(value, datetime) else str(value)
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode()
+
+
+def decodeCursor(cursor: str, parse, parse_id=int):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return parse(value), parse_id(row_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+@contextmanager
+def trigramThreshold(threshold: float):
+    # The `%` operator (TrigramSimilar lookup) can be served by the gin_trgm_ops
+    # indexes but compares against pg_trgm.similarity_threshold, so the threshold
+    # is set for the current transaction only. Evaluate the queries inside
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", [str(threshold)])
+        yield
+
+
+def searchSongs(search_string: str):
+    # Songs whose stored search document matches, or whose name, artist or
+    # album name is trigram similar, best first. The matches are collected as a
+    # UNION so that every branch can use its own index (an OR across tables
+    # cannot); run inside trigramThreshold(SONG_SIMILARITY_THRESHOLD)
+    search_query = SearchQuery(search_string)
+    matching_ids = Song.objects.filter(search_document=search_query).values('id').union(
+        Song.objects.filter(TrigramSimilar(F('name'), search_string)).values('id'),
+        ArtistSong.objects.filter(
+            artist__in=Artist.objects.filter(TrigramSimilar(F('name'), search_string)).values('id')
+        ).values('song_id'),
+        AlbumSong.objects.filter(
+            album__in=Album.objects.filter(TrigramSimilar(F('name'), search_string)).values('id')
+        ).values('song_id'),
+    ).order_by()
+    return Song.objects.filter(id__in=matching_ids).annotate(
+        # double precision so that the value round trips exactly through the page cursor
+        relevance=Cast(SearchRank(F('search_document'), search_query) + TrigramSimilarity('name', search_string),
+                       FloatField()),
+        album_names=ArraySubquery(Album.objects.filter(albumsong__song=OuterRef('pk')).values('name')),
+        artist_names=ArraySubquery(Artist.objects.filter(artistsong__song=OuterRef('pk')).values('name')),
+    ).order_by('-relevance', 'id')
+
+
+def searchSongsPage(search_string: str, cursor=None, number_of_songs=SEARCH_PAGE_SIZE):
+    # One page of searchSongs, ranked and cut by the database so that a broad
+    # term costs about the same as a narrow one. Returns the songs and the
+    # cursor of the next page (None on the last one)
+    songs = searchSongs(search_string)
+    if cursor is not None:
+        relevance, song_id = decodeCursor(cursor, float, str)
+        songs = songs.filter(Q(relevance__lt=relevance) | Q(relevance=relevance, id__gt=song_id))
+    with trigramThreshold(SONG_SIMILARITY_THRESHOLD):
+        page = list(songs[:number_of_songs + 1])
+    next_cursor = None
+    if len(page) > number_of_songs:
+        page = page[:number_of_songs]
+        next_cursor = encodeCursor(page[-1].relevance, page[-1].id)
+    return page, next_cursor
+
+
+def searchNames(model, search_text: str):
+    # Rows of a model with a `name` column (Artist, Album, Genre, ...) whose name
+    # is trigram similar, most similar first
+    return model.objects.annotate(
+        similarity=TrigramSimilarity('name', search_text)
+    ).filter(TrigramSimilar(F('name'), search_text)).order_by('-similarity', 'id')
+
+
+# Search results are cached per process under the current catalog version,
+# which lives in the shared cache and is bumped by every catalog write, so a
+# cached result never outlives a change in any worker. Versions are
+# timestamps that only grow, a version culled from the shared cache is
+# replaced by a newer one rather than one old results were cached under.
+# Each process reuses the version it read for CATALOG_VERSION_LOCAL_SECONDS,
+# writes of other workers show up in its searches after at most that long
+SEARCH_CACHE_TIMEOUT = 5 * 60
+CATALOG_VERSION_KEY = 'catalog_version'
+CATALOG_VERSION_LOCAL_SECONDS = 5
+
+
+def getCatalogVersion():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        caches['shared'].add(CATALOG_VERSION_KEY, time.time_ns(), None)
+        version = caches['shared'].get(CATALOG_VERSION_KEY)
+        cache.set(CATALOG_VERSION_KEY, version, CATALOG_VERSION_LOCAL_SECONDS)
+    return version
+
+
+def bumpCatalogVersion():
+    # Called after new songs, artists, albums or genres are written. Newer
+    # than the current version even when the clocks of the workers disagree
+    version = max(time.time_ns(), (caches['shared'].get(CATALOG_VERSION_KEY) or 0) + 1)
+    caches['shared'].set(CATALOG_VERSION_KEY, version, None)
+    cache.set(CATALOG_VERSION_KEY, version, CATALOG_VERSION_LOCAL_SECONDS)
+
+
+def cachedSearch(endpoint: str, search_string: str, limit: int, compute, cursor=None):
+    # The result of compute() for (endpoint, normalized query, limit, cursor)
+    # in the current catalog version; results must be picklable (not querysets)
+    query_hash = hashlib.sha1(normalizeQuery(search_string).encode()).hexdigest()
+    key = f'search:{getCatalogVersion()}:{endpoint}:{limit}:{cursor or ""}:{query_hash}'
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, SEARCH_CACHE_TIMEOUT)
+    return result
+
+
+def serializeSearchSong(song: Song):
+    # Songs from searchSongs, with their album and artist name annotations
+    return {
+        'spotify_id': song.id,
+        'track_name': song.name,
+        'release_year': song.release_year,
+        'album_name': song.album_names,
+        'artist': song.artist_names,
+        'album_url': song.img_url,
+    }
+
+
+def searchSongsInfo(search_string: str, cursor=None, number_of_songs=SEARCH_PAGE_SIZE):
+    songs, next_cursor = searchSongsPage(search_string, cursor, number_of_songs)
+    return [serializeSearchSong(song) for song in songs], next_cursor
+
+
+def serializeSpotifyTrack(track):
+    return {
+        'track_name': track['name'],
+        'album_name': track['album']['name'],
+        'artist': ', '.join([artist['name'] for artist in track['artists']]),
+        'release_year': track['album']['release_date'][:4],
+        'spotify_id': track['id'],
+        'album_url': track['album']['images'][0]['url'],
+    }
+
+
+spotify_client = None
+
+
+def getSpotifyClient():
+    # One client per process so the client credentials token is reused until
+    # it expires. Rate limited calls are not retried here, the callers fall
+    # back to local results instead
+    global spotify_client
+    if spotify_client is None:
+        client_credentials = SpotifyClientCredentials(client_id=os.getenv('SPOTIPY_CLIENT_ID'), client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'))
+        spotify_client = spotipy.Spotify(client_credentials_manager=client_credentials, retries=0, status_retries=0)
+    return spotify_client
+
+
+def normalizeQuery(search_string: str):
+    return ' '.join(search_string.casefold().split())
+
+
+def spotifySearchCacheKey(search_string: str, limit: int):
+    return f'spotify_search:{limit}:{hashlib.sha1(normalizeQuery(search_string).encode()).hexdigest()}'
+
+
+def searchSpotifyTracks(search_string: str, limit=10):
+    # Spotify track search, cached by the normalized query in the
+    # spotify_search cache (TTL and LRU eviction are configured there)
+    key = spotifySearchCacheKey(search_string, limit)
+    tracks = caches['spotify_search'].get(key)
+    if tracks is None:
+        results = getSpotifyClient().search(q=search_string, type='track', limit=limit)
+        tracks = [serializeSpotifyTrack(track) for track in results['tracks']['items']]
+        caches['spotify_search'].set(key, tracks)
+    return tracks
+
+
+def annotateInCatalog(tracks):
+    # Marks the Spotify tracks we already have, with a single query
+    catalog_ids = set(Song.objects.filter(id__in=[track['spotify_id'] for track in tracks])
+                      .values_list('id', flat=True))
+    return [{**track, 'in_catalog': track['spotify_id'] in catalog_ids} for track in tracks]
+
+
+def serializeLocalTrack(song: Song):
+    # A searchSongs result in the shape of serializeSpotifyTrack
+    return {
+        'track_name': song.name,
+        'album_name': song.album_names[0] if song.album_names else '',
+        'artist': ', '.join(song.artist_names),
+        'release_year': str(song.release_year),
+        'spotify_id': song.id,
+        'album_url': song.img_url,
+        'in_catalog': True,
+    }
+
+
+# Seconds each section of federatedSearch may take before it is left out of
+# the response. Database sections are also cancelled by a statement timeout
+SEARCH_SECTION_BUDGETS = {
+    'songs': 1.0,
+    'artists': 0.5,
+    'albums': 0.5,
+    'genres': 0.5,
+    'spotify': 1.5,
+}
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix='search')
+
+
+def runSearchSection(query, budget: float, uses_database=True):
+    # Runs in a SEARCH_EXECUTOR thread, which keeps its own database
+    # connection between tasks for CONN_MAX_AGE like a request thread does
+    if not uses_database:
+        return query()
+    close_old_connections()
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(int(budget * 1000))])
+            return query()
+    finally:
+        close_old_connections()
+
+
+def searchNamesInfo(model, search_string: str, number_of_results: int):
+    with trigramThreshold(NAME_SIMILARITY_THRESHOLD):
+        return [{'id': row.id, 'name': row.name}
+                for row in searchNames(model, search_string)[:number_of_results]]
+
+
+def federatedSearch(search_string: str, number_of_results=10, include_spotify=False, max_budget=None):
+    # Songs, artists, albums, genres and optionally Spotify tracks for one
+    # search string. The sections run concurrently and each one is waited for
+    # until its own budget runs out, so a slow section (usually Spotify) only
+    # drops itself from the response. Returns the sections and the names of
+    # the ones that timed out or failed
+    budgets = {section: min(budget, max_budget) if max_budget is not None else budget
+               for section, budget in SEARCH_SECTION_BUDGETS.items()}
+    queries = {
+        'songs': lambda: [serializeSearchSong(song)
+                          for song in searchSongsPage(search_string, None, number_of_results)[0]],
+        'artists': lambda: searchNamesInfo(Artist, search_string, number_of_results),
+        'albums': lambda: searchNamesInfo(Album, search_string, number_of_results),
+        'genres': lambda: searchNamesInfo(Genre, search_string, number_of_results),
+    }
+    if include_spotify:
+        queries['spotify'] = lambda: annotateInCatalog(searchSpotifyTracks(search_string, number_of_results))
+    started_at = time.monotonic()
+    futures = {section: SEARCH_EXECUTOR.submit(runSearchSection, query, budgets[section],
+                                               section != 'spotify')
+               for section, query in queries.items()}
+    results, timed_out, failed = {}, [], []
+    for section, future in futures.items():
+        try:
+            results[section] = future.result(timeout=max(started_at + budgets[section] - time.monotonic(), 0))
+        except FutureTimeoutError:
+            results[section] = []
+            timed_out.append(section)
+        except Exception as e:
+            logging.error(f"Search section {section} failed: {str(e)}")
+            results[section] = []
+            failed.append(section)
+    return results, timed_out, failed
+
+
+# Rows a TABLESAMPLE round of randomSample reads, and the number of rounds
+RANDOM_SAMPLE_ROWS = 1000
+RANDOM_SAMPLE_ROUNDS = 2
+
+
+def randomSample(queryset, k: int):
+    # Up to k distinct random rows of a filtered Song queryset, or ids when it
+    # is a values_list('id', flat=True), whatever the id format. Each round
+    # reads RANDOM_SAMPLE_ROWS rows from random blocks of the table with
+    # TABLESAMPLE SYSTEM_ROWS and picks among the ones the filters match, so
+    # the cost does not grow with the table. A set matching too few of the
+    # sampled rows is topped up by ordering it by random(), a read of the
+    # whole set. The whole catalog is sampled with GENRE_SONG_INDEX.sampleSongs
+    queryset = queryset.order_by()
+    sample, seen = [], set()
+    sampled_ids = RawSQL(f'SELECT id FROM {queryset.model._meta.db_table} TABLESAMPLE SYSTEM_ROWS (%s)',
+                         [max(RANDOM_SAMPLE_ROWS, k)])
+
+    def add(rows):
+        for row in rows:
+            row_id = row.pk if isinstance(row, Model) else row
+            if row_id not in seen and len(sample) < k:
+                seen.add(row_id)
+                sample.append(row)
+
+    for _ in range(RANDOM_SAMPLE_ROUNDS):
+        if len(sample) >= k:
+            break
+        rows = list(queryset.filter(id__in=sampled_ids))
+        random.shuffle(rows)
+        add(rows)
+    if len(sample) < k:
+        add(queryset.exclude(id__in=seen).order_by('?')[:k - len(sample)])
+    return sample
 
 
 def bulk_get_or_create(model: Model, data: List, unique_field: str) -> Tuple[List[Model], List[Model]]:
@@ -132,12 +458,6 @@ def flush_database():
                 artist.hard_delete()
 
 
-def getFirstRelatedSong(genre_id):
-    genre = Genre.objects.get(id=genre_id)
-    genre_song = genre.genresong_set.order_by('-created_at').first()
-    return genre_song.song.img_url
-
-
 def add_song_helper(track=None):
     client_credentials = SpotifyClientCredentials(client_id=os.getenv('SPOTIPY_CLIENT_ID'), client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'))
     sp = spotipy.Spotify(client_credentials_manager=client_credentials)
@@ -181,6 +501,9 @@ def add_song_helper(track=None):
                     if genre_name:
                         genre, genre_created = Genre.objects.get_or_create(name=genre_name)
                         new_song.genres.add(genre)
+                genre_ids = list(new_song.genres.values_list('id', flat=True))
+                Genre.refresh_stats(genre_ids)
+                GENRE_SONG_INDEX.refreshIfBuilt()
 
                 for artist in track['artists']:
                     artist_name = artist['name'].title()
@@ -208,6 +531,11 @@ def add_song_helper(track=None):
                                                                             release_year=track['album']['release_date'][:4],
                                                                             img_url=track['album']['images'][0]['url'])
                 new_song.albums.add(album_instance)
+                Song.refresh_search_documents([new_song.id])
+                # Once the song is complete
+                SONG_FEATURES.insert(new_song.id, (tempo, mood, recorded_environment, int(new_song.release_year)),
+                                     genre_ids)
+                bumpCatalogVersion()
                 return {'message': 'Song added successfully'}
             else:
                 return {'error': "You have already added this song"}
@@ -308,31 +636,52 @@ def addArtistsToSongsWithoutArtists():
     return print('message: Songs added successfully')
 
 
-def serializePlaylistInfo(playlist: Playlist):
-    count = 4
-    if playlist.songs.count() < 4:
-        count = playlist.songs.count()
-    song_imgs = [song.img_url
-                 for song in
-                 playlist.songs.all()[:count]]
+PLAYLIST_COVER_SIZE = 4
+
+
+def getPlaylistCovers(playlist_ids):
+    # Up to PLAYLIST_COVER_SIZE song images per playlist, all in one windowed query
+    covers = {playlist_id: [] for playlist_id in playlist_ids}
+    rows = PlaylistSong.all_objects.filter(
+        playlist_id__in=playlist_ids,
+        song__is_deleted=False, song__is_active=True,
+    ).annotate(
+        position=Window(RowNumber(),
+                        partition_by=[F('playlist_id')],
+                        order_by=[F('song_id').asc()])
+    ).filter(position__lte=PLAYLIST_COVER_SIZE).order_by('playlist_id', 'position') \
+        .values_list('playlist_id', 'song__img_url')
+    for playlist_id, img_url in rows:
+        covers[playlist_id].append(img_url)
+    return covers
+
+
+def serializePlaylistInfo(playlist: Playlist, song_imgs=None):
+    if song_imgs is None:
+        song_imgs = getPlaylistCovers([playlist.id])[playlist.id]
     return {
         'id': playlist.id,
         'name': playlist.name,
         'description': playlist.description,
         'song_imgs': song_imgs,
-        'user_id': playlist.user.id if playlist.user is not None else None,
-        'friend_group_id':
-            playlist.friend_group.id if
-            playlist.friend_group is not None else None,
+        'user_id': playlist.user_id,
+        'friend_group_id': playlist.friend_group_id,
     }
 
 
+def serializePlaylistsInfo(playlists):
+    playlists = list(playlists)
+    covers = getPlaylistCovers([playlist.id for playlist in playlists])
+    return [serializePlaylistInfo(playlist, covers[playlist.id])
+            for playlist in playlists]
+
+
 def serializePlaylist(playlist: Playlist):
     return {
         'id': playlist.id,
         'name': playlist.name,
         'description': playlist.description,
-        'songs': [serializeSongMinimum(song) for song in playlist.songs.all()],
+        'songs': serializeSongsMinimum(playlist.songs.all()),
         'user_id': playlist.user.id if playlist.user is not None else None,
         'friend_group_id':
             playlist.friend_group.id if
@@ -340,16 +689,37 @@ def serializePlaylist(playlist: Playlist):
     }
 
 
-def serializeSongMinimum(song: Song):
+def withSongRelations(songs, *relations):
+    # Accepts a Song queryset, a list of Song objects or a list of song ids and
+    # returns the songs as a list with the given relations prefetched, so
+    # serializing them costs one query per relation instead of one per song.
+    if isinstance(songs, QuerySet):
+        return list(songs.prefetch_related(*relations))
+    songs = list(songs)
+    if songs and not isinstance(songs[0], Song):
+        songs_by_id = Song.objects.in_bulk(songs)
+        songs = [songs_by_id[song_id] for song_id in songs if song_id in songs_by_id]
+    prefetch_related_objects(songs, *relations)
+    return songs
+
+
+def serializeSongMinimum(song: Song, default_artist=None):
+    # Slicing .all() reuses the prefetched artists when there are any
+    main_artist = song.artists.all()[:1]
     return {
         'id': song.id,
         'name': song.name,
         'release_year': song.release_year,
         'img_url': song.img_url,
-        'main_artist': song.artists.all().first().name if song.artists.all().first() is not None else None,
+        'main_artist': main_artist[0].name if main_artist else default_artist,
     }
 
 
+def serializeSongsMinimum(songs, default_artist=None):
+    return [serializeSongMinimum(song, default_artist)
+            for song in withSongRelations(songs, 'artists')]
+
+
 def serializeSong(song: Song):
     return {
         'id': song.id,
@@ -367,6 +737,11 @@ def serializeSong(song: Song):
     }
 
 
+def serializeSongs(songs):
+    return [serializeSong(song)
+            for song in withSongRelations(songs, 'genres', 'artists', 'albums')]
+
+
 def serializeSongExtended(song: Song):
     genres = song.genres.all()
     genre_names = [genre.name for genre in genres]
@@ -403,6 +778,12 @@ def serializeSongExtended(song: Song):
     return data
 
 
+def serializeSongsExtended(songs):
+    return [serializeSongExtended(song)
+            for song in withSongRelations(songs, 'genres', 'artists',
+                                          'albums', 'instruments')]
+
+
 def serializeSongExtendedWithRating(song: Song, user: User):
     data = serializeSongExtended(song)
 
@@ -2,17 +2,22 @@ import json
 from datetime import timedelta
 import os
 import logging
-import random
 from django.http import JsonResponse, HttpResponse
-from django.db.models import Count, Sum, Q
+from django.db.models import Count, Sum, Q, F
 from django.views.decorators.csrf import csrf_exempt
 import spotipy
 from OVTF_Backend.firebase_auth import token_required
 from apps.songs.utils import bulk_get_or_create, flush_database, get_artist_bio, get_genres_and_artist_info, \
-    getFirstRelatedSong, serializeSongMinimum
+    serializeSongMinimum, serializeSongsMinimum, searchSongsPage, searchSongsInfo, searchNamesInfo, \
+    searchSpotifyTracks, annotateInCatalog, serializeLocalTrack, federatedSearch, cachedSearch, \
+    bumpCatalogVersion, randomSample, SEARCH_PAGE_SIZE, SEARCH_MAX_RESULTS
+from songs.autocomplete import autocomplete, AUTOCOMPLETE_RESULTS
+from songs.genre_index import GENRE_SONG_INDEX
+from songs.song_features import SONG_FEATURES, SIMILAR_PROBES
 from songs.models import (Instrument, Mood, RecordedEnvironment,
                           Song, Artist, Album, ArtistSong,
                           AlbumSong, Genre, GenreSong, Tempo, Playlist, PlaylistSong)
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyClientCredentials
 from users.models import User, UserSongRating
 from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank, TrigramSimilarity
@@ -36,48 +41,52 @@ def search_db(request, userid):
         data = request.GET
         search_string = data.get('search_string', '')
 
-        search_fields = ['name', 'albums', 'artists']
-
-        if not search_string or not search_fields:
+        if not search_string:
             return JsonResponse({'error': 'Missing parameters'}, status=400)
 
-        # Prepare the search query and vector
-        search_query = SearchQuery(search_string)
-        search_vector = SearchVector('name', 'albums__name', 'artists__name')
-
-        # Annotate each song with its search rank and trigram similarity
-        songs = Song.objects.annotate(
-            rank=SearchRank(search_vector, search_query),
-            similarity=TrigramSimilarity('name', search_string) +
-                       TrigramSimilarity('albums__name', search_string) +
-                       TrigramSimilarity('artists__name', search_string)
-        ).filter(
-            Q(rank__gte=0.4) | 
-            Q(similarity__gt=0.4)
-        ).distinct('id')
-
-        # Sort the results in Python to maintain the desired order
-        sorted_songs = sorted(songs, key=lambda x: (-x.rank, -x.similarity))
-
-        # Convert the sorted list to a list of song dictionaries for JsonResponse
-        songs_info = []
-        for song in sorted_songs:
-            song_info = {
-                'spotify_id': song.id,
-                'track_name': song.name,
-                'release_year': song.release_year,
-                'album_name': [album.name for album in song.albums.all()],
-                'artist': [artist.name for artist in song.artists.all()],
-                'album_url': song.img_url,
-            }
-            songs_info.append(song_info)
-
-        return JsonResponse({'message': 'Songs found', 'songs_info': songs_info}, status=200)
+        try:
+            number_of_songs = int(data.get('number_of_songs', SEARCH_PAGE_SIZE))
+            if number_of_songs < 1:
+                raise ValueError('Invalid number of songs')
+            songs_info, next_cursor = cachedSearch('search_db', search_string, number_of_songs,
+                                                   lambda: searchSongsInfo(search_string, data.get('cursor'),
+                                                                           number_of_songs),
+                                                   data.get('cursor'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e) or 'Invalid number of songs'}, status=400)
+
+        return JsonResponse({'message': 'Songs found', 'songs_info': songs_info,
+                             'next_cursor': next_cursor}, status=200)
 
     else:
         return JsonResponse({'error': 'Invalid method'}, status=400)
 
 
+@csrf_exempt
+@token_required
+def search(request, userid):
+    # Songs, artists, albums, genres and (with include_spotify) Spotify tracks
+    # in one response; sections that exceed their time budget come back empty
+    # and are listed in timed_out
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid method'}, status=400)
+    data = request.GET
+    search_string = data.get('search_string')
+    if not search_string:
+        return JsonResponse({'error': 'Missing search string'}, status=400)
+    try:
+        number_of_results = int(data.get('number_of_results', 10))
+        max_budget = int(data['budget_ms']) / 1000 if 'budget_ms' in data else None
+        if not 1 <= number_of_results <= SEARCH_MAX_RESULTS or (max_budget is not None and max_budget <= 0):
+            raise ValueError
+    except ValueError:
+        return JsonResponse({'error': 'Invalid parameters'}, status=400)
+    include_spotify = data.get('include_spotify', 'false').lower() == 'true'
+    results, timed_out, failed = federatedSearch(search_string, number_of_results, include_spotify, max_budget)
+    return JsonResponse({'message': 'Search successful', **results,
+                         'timed_out': timed_out, 'failed': failed}, status=200)
+
+
 @csrf_exempt
 @token_required
 def get_song_by_id(request, userid):
@@ -165,7 +174,7 @@ def add_song(request, userid):
         if request.method != 'POST':
             return JsonResponse({'error': 'Invalid method'}, status=400)
         else:
-            data = json.loads(request.body, encoding='utf-8')
+            data = json.loads(request.body)
             spotify_id = data.get('spotify_id')  # Add this line to get Spotify ID from the request
             rating = float(data.get('rating'))
 
@@ -216,6 +225,9 @@ def add_song(request, userid):
                             if genre_name:
                                 genre, genre_created = Genre.objects.get_or_create(name=genre_name)
                                 new_song.genres.add(genre)
+                        genre_ids = list(new_song.genres.values_list('id', flat=True))
+                        Genre.refresh_stats(genre_ids)
+                        GENRE_SONG_INDEX.refreshIfBuilt()
                         
                         for artist in track['artists']:
                             artist_name = artist['name'].title()
@@ -240,6 +252,11 @@ def add_song(request, userid):
                         album_name = track['album']['name'].title() if 'album' in track and 'name' in track['album'] else track['name'].title() + ' - Single'
                         album_instance, album_created = Album.objects.get_or_create(id = track['album']['id'] ,name=album_name, release_year=track['album']['release_date'][:4], img_url=track['album']['images'][0]['url'])
                         new_song.albums.add(album_instance)
+                        Song.refresh_search_documents([new_song.id])
+                        # Searchable by the song features model until its next build
+                        SONG_FEATURES.insert(new_song.id, (tempo, mood, recorded_environment,
+                                                           int(new_song.release_year)), genre_ids)
+                        bumpCatalogVersion()
 
                     if rating > 0 and rating <= 5:
                         try:
@@ -281,24 +298,18 @@ def search_spotify(request, userid):
             if search_string is None:
                 return JsonResponse({'error': 'Missing search string'}, status=400)
             
-            client_credentials = SpotifyClientCredentials(client_id=os.getenv('SPOTIPY_CLIENT_ID'), client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'))
-            sp = spotipy.Spotify(client_credentials_manager=client_credentials)
-
-            results = sp.search(q=search_string, type='track', limit=10)
-
-            search_list = []
-
-            for track in results['tracks']['items']:
-                song_info = {
-                    'track_name': track['name'],
-                    'album_name': track['album']['name'],
-                    'artist': ', '.join([artist['name'] for artist in track['artists']]),
-                    'release_year': track['album']['release_date'][:4],
-                    'spotify_id': track['id'],
-                    'album_url' : track['album']['images'][0]['url'],
-                }
-                search_list.append(song_info)
-            return JsonResponse({'message': 'Search successful', 'results': search_list}, status=200)
+            try:
+                search_list = annotateInCatalog(searchSpotifyTracks(search_string))
+                source = 'spotify'
+            except SpotifyException as e:
+                if e.http_status != 429:
+                    raise
+                logging.warning(f"Spotify rate limited the search, falling back to the catalog: {str(e)}")
+                songs, _ = searchSongsPage(search_string, None, 10)
+                search_list = [serializeLocalTrack(song) for song in songs]
+                source = 'local'
+            return JsonResponse({'message': 'Search successful', 'results': search_list,
+                                 'source': source}, status=200)
         else:
             return JsonResponse({'error': 'Invalid method'}, status=400)
             
@@ -321,6 +332,7 @@ def create_genre(request):
             return HttpResponse(status=400)
         genre = Genre(name=genre_name)
         genre.save()
+        bumpCatalogVersion()
         return HttpResponse(status=201)
     except Exception as e:
         # TODO logging.("create_user: " + str(e))
@@ -434,16 +446,7 @@ def get_songs_by_genre(request, userid):
             songs = Song.objects.filter(genres__name=genre_name).order_by('-created_at').all()
         else:
             songs = Song.objects.filter(genres__name=genre_name).order_by('-created_at')[:number_of_songs]
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'main_artist': song.artists.first().name if song.artists.exists() else "Unknown",
-                'img_url': song.img_url
-            }
-            for song in songs
-        ]
+        serialized_songs = serializeSongsMinimum(songs, default_artist="Unknown")
         return JsonResponse({'songs': serialized_songs}, status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
@@ -491,13 +494,12 @@ def get_random_genres(request, userid):
         number_of_genres = int(number_of_genres)
         if number_of_genres <= 0:
             return JsonResponse({'error': 'Invalid number of genres'}, status=400)
-        genres = Genre.objects.annotate(num_songs=Count('genresong'))\
-                              .order_by('-num_songs')[:number_of_genres]
+        genres = Genre.objects.order_by('-song_count', 'id')[:number_of_genres]
         serialized_genres = [
             {
                 'id': genre.id,
                 'name': genre.name,
-                'img_url': getFirstRelatedSong(genre.id)
+                'img_url': genre.cover_img_url
             }
             for genre in genres
         ]
@@ -518,30 +520,20 @@ def search_artists(request, userid):
         search_text = data.get('search_text')
         number_of_artists = data.get('number_of_artists', 10)
         if search_text:
-            # Prepare the search query and vector
-            search_query = SearchQuery(search_text)
-            search_vector = SearchVector('name')
-
-            # Annotate each song with its search rank and trigram similarity
-            artists = Artist.objects.annotate(
-                rank=SearchRank(search_vector, search_query),
-                similarity=TrigramSimilarity('name', search_text)
-            ).filter(
-                Q(rank__gte=0.2) |
-                Q(similarity__gt=0.2))\
-             .order_by("-similarity")[:number_of_artists]
+            try:
+                number_of_artists = int(number_of_artists)
+                if not 1 <= number_of_artists <= SEARCH_MAX_RESULTS:
+                    raise ValueError
+            except ValueError:
+                return JsonResponse({'error': 'Invalid number of artists'}, status=400)
+            artists_info = cachedSearch('search_artists', search_text, number_of_artists,
+                                        lambda: [{'name': artist['name']} for artist in
+                                                 searchNamesInfo(Artist, search_text, number_of_artists)])
 
         else:
             return JsonResponse({'error': 'Missing search text'},
                                 status=400)
 
-        artists_info = [
-            {
-                'name': artist.name,
-            }
-            for artist in artists
-        ]
-
         return JsonResponse({'message': 'Artists found', 'artists_info': artists_info}, status=200)
 
     else:
@@ -556,27 +548,19 @@ def search_genres(request, userid):
         search_text = data.get('search_text')
         number_of_genres = data.get('number_of_genres', 10)
         if search_text:
-            # Prepare the search query and vector
-            search_query = SearchQuery(search_text)
-            search_vector = SearchVector('name')
-
-            # Annotate each song with its search rank and trigram similarity
-            genres = Genre.objects.annotate(
-                rank=SearchRank(search_vector, search_query),
-                similarity=TrigramSimilarity('name', search_text)
-            ).filter(
-                Q(rank__gte=0.2) |
-                Q(similarity__gt=0.2))\
-             .order_by("-similarity")[:number_of_genres]
+            try:
+                number_of_genres = int(number_of_genres)
+                if not 1 <= number_of_genres <= SEARCH_MAX_RESULTS:
+                    raise ValueError
+            except ValueError:
+                return JsonResponse({'error': 'Invalid number of genres'}, status=400)
+            genres_info = cachedSearch('search_genres', search_text, number_of_genres,
+                                       lambda: [{'name': genre['name']} for genre in
+                                                searchNamesInfo(Genre, search_text, number_of_genres)])
+
         else:
             return JsonResponse({'error': 'Missing search text'},
                                 status=400)
-        genres_info = [
-            {
-                'name': genre.name,
-            }
-            for genre in genres
-        ]
 
         return JsonResponse({'message': 'Genres found',
                              'genres_info': genres_info},
@@ -587,6 +571,50 @@ def search_genres(request, userid):
                             status=400)
 
 
+@csrf_exempt
+@token_required
+def autocomplete_names(request, userid):
+    # Search-as-you-type suggestions served from the in-process prefix index
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid method'}, status=400)
+    data = request.GET
+    search_text = data.get('search_text')
+    if not search_text:
+        return JsonResponse({'error': 'Missing search text'}, status=400)
+    try:
+        number_of_results = int(data.get('number_of_results', AUTOCOMPLETE_RESULTS))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid number of results'}, status=400)
+    return JsonResponse({'message': 'Names found', **autocomplete(search_text, number_of_results)}, status=200)
+
+
+@csrf_exempt
+@token_required
+def similar_songs(request, userid):
+    # Songs closest to a song in content features, from the approximate
+    # similarity index; probes trades latency for recall
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid method'}, status=400)
+    data = request.GET
+    song_id = data.get('song_id')
+    if not song_id:
+        return JsonResponse({'error': 'Missing song id'}, status=400)
+    try:
+        number_of_songs = int(data.get('number_of_songs', 10))
+        probes = int(data.get('probes', SIMILAR_PROBES))
+    except ValueError:
+        return JsonResponse({'error': 'Wrong parameter'}, status=400)
+    if not 1 <= number_of_songs <= 100 or probes < 1:
+        return JsonResponse({'error': 'Wrong parameter'}, status=400)
+    if SONG_FEATURES.model.load() is None:
+        return JsonResponse({'error': 'Song similarity index is not built'}, status=503)
+    taste = SONG_FEATURES.tasteVector([(song_id, 1)])
+    if taste is None:
+        return JsonResponse({'error': 'Song not found'}, status=404)
+    songs = SONG_FEATURES.similar(taste, number_of_songs, exclude=[song_id], probes=probes)
+    return JsonResponse({'message': 'Similar songs found', 'songs': serializeSongsMinimum(songs)}, status=200)
+
+
 @csrf_exempt
 @token_required
 def get_all_moods(request, userid):
@@ -661,13 +689,10 @@ def get_banger_songs(request, userid):
             else:
                 songs = songs.filter(tempo=tempo)
 
-        # Randomize the order and retrieve one song
-        if songs.exists():
-            ids = songs.values_list('id', flat=True)
-            random_id = random.sample(list(ids), 1)[0]
-            random_song = songs.get(id=random_id)
-
-            song_info = serializeSongMinimum(random_song)
+        # Retrieve one random song
+        random_songs = randomSample(songs, 1)
+        if random_songs:
+            song_info = serializeSongMinimum(random_songs[0])
 
             return JsonResponse({'message': 'Random Banger song found', 'song_info': song_info}, status=200)
         else:
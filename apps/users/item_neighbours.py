@@ -0,0 +1,53 @@
+import numpy as np
+
+from songs.model_files import MappedModel, saveModelArrays, songPositions
+
+# Number of neighbours kept per song by build_item_neighbours
+ITEM_NEIGHBOURS = 50
+
+
+def saveItemNeighbours(song_ids, neighbours, scores, directory=None):
+    # song_ids must be sorted, neighbours[i] holds positions in song_ids (-1
+    # when a song has less than k neighbours) and scores[i] their similarities
+    saveModelArrays('item', {'song_ids': song_ids,
+                             'neighbours': neighbours.astype(np.int32),
+                             'scores': scores.astype(np.float32)}, directory)
+
+
+class ItemNeighbours:
+    # Item-item neighbours computed offline from all ratings, memory mapped
+    def __init__(self):
+        self.model = MappedModel('item', ('song_ids', 'neighbours', 'scores'))
+
+    def reset(self):
+        self.model.reset()
+
+    def recommend(self, ratings, k: int):
+        # Up to k song ids scored by sum(similarity * rating) over the rated
+        # songs, excluding them. ratings is a list of (song_id, rating); None
+        # when no model was built or none of the songs is in it
+        model = self.model.load()
+        if model is None or not ratings:
+            return None
+        song_ids = model['song_ids']
+        positions, known = songPositions(song_ids, [song_id for song_id, _ in ratings])
+        if not known.any():
+            return None
+        weights = np.array([float(rating) for _, rating in ratings], dtype=np.float32)
+        positions, weights = positions[known], weights[known]
+
+        candidates = model['neighbours'][positions]
+        votes = model['scores'][positions] * weights[:, None]
+        valid = candidates >= 0
+        candidates, inverse = np.unique(candidates[valid], return_inverse=True)
+        totals = np.bincount(inverse, weights=votes[valid], minlength=len(candidates))
+        keep = (totals > 0) & ~np.isin(candidates, positions)
+        candidates, totals = candidates[keep], totals[keep]
+        if len(candidates) > k:
+            top = np.argpartition(-totals, k - 1)[:k]
+            candidates, totals = candidates[top], totals[top]
+        ranked = candidates[np.argsort(-totals, kind='stable')]
+        return [song_ids[i].decode() for i in ranked]
+
+
+ITEM_NEIGHBOURS_MODEL = ItemNeighbours()
@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+from scipy import sparse
+
+from users.item_neighbours import ITEM_NEIGHBOURS, saveItemNeighbours
+from users.models import UserSongRating
+
+
+def load_ratings():
+    # (user x song) CSR matrix of the active ratings and the sorted song ids of its columns
+    user_ids, song_ids, ratings = [], [], []
+    rows = UserSongRating.objects.order_by().values_list('user_id', 'song_id', Cast('rating', FloatField()))
+    for user_id, song_id, rating in rows.iterator(chunk_size=10_000):
+        user_ids.append(str(user_id))
+        song_ids.append(song_id.encode())
+        ratings.append(rating)
+    _, user_rows = np.unique(np.array(user_ids), return_inverse=True)
+    columns, song_columns = np.unique(np.array(song_ids, dtype=bytes), return_inverse=True)
+    matrix = sparse.csr_matrix((np.array(ratings, dtype=np.float32), (user_rows, song_columns)),
+                               shape=(user_rows.max(initial=-1) + 1, len(columns)))
+    # A song rated twice by the same user keeps the mean of the ratings
+    counts = sparse.csr_matrix((np.ones(len(ratings), dtype=np.float32), (user_rows, song_columns)),
+                               shape=matrix.shape)
+    matrix.data /= counts.data
+    return matrix, columns
+
+
+def centered_columns(matrix):
+    # Ratings minus the user's mean rating (adjusted cosine), so a song is
+    # close to the ones rated above or below average by the same users, and
+    # columns scaled to unit length so a dot product is the cosine similarity
+    matrix = matrix.copy()
+    counts = np.diff(matrix.indptr)
+    means = np.asarray(matrix.sum(axis=1)).ravel() / np.maximum(counts, 1)
+    matrix.data -= np.repeat(means, counts).astype(np.float32)
+    matrix.eliminate_zeros()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    return (matrix @ sparse.diags(1 / norms).astype(np.float32)).tocsc()
+
+
+def top_neighbours(matrix, k: int, block_size: int):
+    # Top k positively similar songs of every song. The song x song
+    # similarity matrix is only ever materialized block_size rows at a time
+    normalized = centered_columns(matrix)
+    transposed = normalized.T.tocsr()
+    number_of_songs = matrix.shape[1]
+    neighbours = np.full((number_of_songs, k), -1, dtype=np.int32)
+    scores = np.zeros((number_of_songs, k), dtype=np.float32)
+    for start in range(0, number_of_songs, block_size):
+        similarities = (transposed[start:start + block_size] @ normalized).tocsr()
+        rows = np.repeat(np.arange(similarities.shape[0]), np.diff(similarities.indptr))
+        similarities.data[similarities.indices == rows + start] = 0
+        for row in range(similarities.shape[0]):
+            begin, end = similarities.indptr[row], similarities.indptr[row + 1]
+            values, columns = similarities.data[begin:end], similarities.indices[begin:end]
+            positive = values > 0
+            values, columns = values[positive], columns[positive]
+            if len(values) > k:
+                top = np.argpartition(-values, k - 1)[:k]
+                values, columns = values[top], columns[top]
+            order = np.argsort(-values, kind='stable')
+            neighbours[start + row, :len(order)] = columns[order]
+            scores[start + row, :len(order)] = values[order]
+    return neighbours, scores
+
+
+class Command(BaseCommand):
+    help = ('Computes the top item-item neighbours of every rated song from all user ratings and saves them '
+            'as memory mapped .npy files read by the "you might like" recommendations.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--neighbours', type=int, default=ITEM_NEIGHBOURS, help='Neighbours kept per song')
+        parser.add_argument('--block-size', type=int, default=1024,
+                            help='Songs whose similarities are computed at once')
+        parser.add_argument('--output', default=None,
+                            help=f'Model directory, defaults to RECOMMENDER_MODEL_DIR ({settings.RECOMMENDER_MODEL_DIR})')
+
+    def handle(self, *args, **options):
+        if options['neighbours'] < 1 or options['block_size'] < 1:
+            raise CommandError('--neighbours and --block-size must be positive')
+        started = time.monotonic()
+        matrix, song_ids = load_ratings()
+        if not matrix.nnz:
+            raise CommandError('There are no ratings to compute neighbours from')
+        loaded = time.monotonic()
+        neighbours, scores = top_neighbours(matrix, options['neighbours'], options['block_size'])
+        saveItemNeighbours(song_ids, neighbours, scores, options['output'])
+        self.stdout.write(f'Saved {options["neighbours"]} neighbours of {len(song_ids)} songs '
+                          f'({matrix.nnz} ratings by {matrix.shape[0]} users) in '
+                          f'{time.monotonic() - started:.1f}s, {loaded - started:.1f}s reading ratings')
@@ -0,0 +1,257 @@
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, transaction
+from django.test.utils import override_settings
+
+from songs.genre_index import GENRE_SONG_INDEX
+from songs.management.commands.benchmark_search import percentiles
+from songs.models import Song
+from songs.song_features import SONG_FEATURES
+from users.item_neighbours import ITEM_NEIGHBOURS_MODEL
+from users.models import UserSongRating
+from users.seen_songs import SEEN_SONGS
+from users.utils import RecommendationContext, get_recommendations, youMightLikeIds
+
+# dec_17_dump.sql predates users 0012, its friend groups without a creator
+# cannot be migrated
+DEFAULT_DUMP = os.path.join(settings.BASE_DIR, 'ovatify_backup_15032024-2.sql')
+
+
+def seed_tracks(context):
+    ratings = list(dict.fromkeys(song_id for song_id, _ in context.ratings))
+    return random.sample(ratings, min(len(ratings), 5))
+
+
+def get_recommendations_engine(context, k: int):
+    items = get_recommendations(seed_tracks=seed_tracks(context), limit=k, seen=context.seen)['items']
+    return None if items is None else [item['id'] for item in items]
+
+
+def taste_engine(context, k: int):
+    items = get_recommendations(seed_tracks=seed_tracks(context), limit=k, taste=context.taste,
+                                seen=context.seen)['items']
+    return None if items is None else [item['id'] for item in items]
+
+
+def unseen(context, song_ids, k: int):
+    return None if song_ids is None else context.seen.unseen(song_ids)[:k]
+
+
+# name -> function(context, k) returning up to k song ids, None when the
+# engine has nothing for the user. A new engine is compared to the others
+# by adding it here
+ENGINES = {
+    'get_recommendations': get_recommendations_engine,
+    'get_recommendations_taste': taste_engine,
+    'item_neighbours': lambda context, k: unseen(
+        context, ITEM_NEIGHBOURS_MODEL.recommend(context.ratings, k + context.seen.extra(k)), k),
+    'song_features': lambda context, k: unseen(
+        context, SONG_FEATURES.recommend(context.ratings, k + context.seen.extra(k)), k),
+    'you_might_like': lambda context, k: youMightLikeIds(context, k)['ids'],
+}
+
+
+def client_environment():
+    # libpq connection parameters of the default database
+    database = connection.settings_dict
+    environment = {**os.environ, 'PGHOST': database['HOST'] or '', 'PGPORT': str(database['PORT'] or ''),
+                   'PGUSER': database['USER'] or '', 'PGPASSWORD': database['PASSWORD'] or ''}
+    for option, variable in (('sslmode', 'PGSSLMODE'), ('options', 'PGOPTIONS')):
+        if database['OPTIONS'].get(option):
+            environment[variable] = database['OPTIONS'][option]
+    return environment
+
+
+def restorable(line: str):
+    # What pg_restore --no-owner --no-privileges leaves out of a plain dump
+    return not (line.startswith(('GRANT ', 'REVOKE ')) or (line.startswith('ALTER ') and ' OWNER TO ' in line))
+
+
+def load_dump(path: str, database: str, psql: str, pg_restore: str):
+    # Plain dumps go through psql, custom format ones (ovatify_backup_15032024.sql)
+    # through pg_restore. Ownership and grants are skipped, the dump's roles
+    # need not exist
+    with open(path, 'rb') as dump:
+        custom = dump.read(5) == b'PGDMP'
+    if custom:
+        command = [pg_restore, '--no-owner', '--no-privileges', '--exit-on-error', '--dbname', database, path]
+        result = subprocess.run(command, env=client_environment(), capture_output=True, text=True)
+    else:
+        command = [psql, '--quiet', '--set', 'ON_ERROR_STOP=1', '--dbname', database]
+        with open(path, encoding='utf-8') as dump:
+            statements = ''.join(filter(restorable, dump))
+        result = subprocess.run(command, input=statements, env=client_environment(), capture_output=True,
+                                text=True)
+    if result.returncode != 0:
+        raise CommandError(f'Loading {path} failed: {result.stderr.strip()}')
+
+
+@contextmanager
+def scratch_database(name: str, dump: str, psql: str, pg_restore: str, keep: bool):
+    # Creates the database, loads the dump and migrates it, then points the
+    # default connection at it the way the test runner does
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{name}"')
+        cursor.execute(f'CREATE DATABASE "{name}"')
+    original = connection.settings_dict['NAME']
+    try:
+        load_dump(dump, name, psql, pg_restore)
+        connection.close()
+        connection.settings_dict['NAME'] = name
+        try:
+            call_command('migrate', verbosity=0, interactive=False)
+        except DatabaseError as e:
+            raise CommandError(f'Migrating {dump} failed: {e}')
+        yield
+    finally:
+        connection.close()
+        connection.settings_dict['NAME'] = original
+        if not keep:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP DATABASE IF EXISTS "{name}"')
+
+
+def hold_out(share: float, min_ratings: int, rng):
+    # Deletes a random share (at least one) of the active ratings of every
+    # user with min_ratings of them and returns user id -> held out song ids
+    ratings = {}
+    for rating_id, user_id, song_id in (UserSongRating.objects.order_by('user_id', 'id')
+                                        .values_list('id', 'user_id', 'song_id')):
+        ratings.setdefault(user_id, []).append((rating_id, song_id))
+    held_out, deleted = {}, []
+    for user_id, user_ratings in ratings.items():
+        if len(user_ratings) < min_ratings:
+            continue
+        picks = rng.sample(user_ratings, max(1, round(len(user_ratings) * share)))
+        held_out[user_id] = {song_id for _, song_id in picks}
+        deleted += [rating_id for rating_id, _ in picks]
+    UserSongRating.all_objects.filter(id__in=deleted).delete()
+    # A user may have rated a held out song more than once
+    for user_id, song_id in UserSongRating.objects.filter(user_id__in=held_out).values_list('user_id', 'song_id'):
+        held_out[user_id].discard(song_id)
+    return {user_id: song_ids for user_id, song_ids in held_out.items() if song_ids}
+
+
+def build_models(directory: str):
+    call_command('build_item_neighbours', output=directory, stdout=io.StringIO())
+    call_command('build_song_features', output=directory, stdout=io.StringIO())
+
+
+def evaluate(engines, held_out, k: int, catalog_size: int, log):
+    # precision@k and recall@k averaged over the users, the share of the
+    # catalog recommended to anyone and the latency of every call
+    totals = {name: {'precision': 0.0, 'recall': 0.0, 'empty': 0, 'songs': set(), 'latencies': []}
+              for name in engines}
+    # Untimed, the first calls build the genre index and map the models
+    context = RecommendationContext(next(iter(held_out)))
+    context.load({'you_might_like'})
+    for engine in engines.values():
+        engine(context, k)
+    for index, (user_id, relevant) in enumerate(held_out.items(), start=1):
+        context = RecommendationContext(user_id)
+        context.load({'you_might_like'})
+        for name, engine in engines.items():
+            started_at = time.perf_counter()
+            song_ids = engine(context, k) or []
+            totals[name]['latencies'].append((time.perf_counter() - started_at) * 1000)
+            hits = len(relevant.intersection(song_ids[:k]))
+            totals[name]['precision'] += hits / k
+            totals[name]['recall'] += hits / len(relevant)
+            totals[name]['empty'] += not song_ids
+            totals[name]['songs'].update(song_ids[:k])
+        if index % 100 == 0:
+            log(f'  {index}/{len(held_out)} users')
+    users = max(len(held_out), 1)
+    return {name: {f'precision@{k}': round(total['precision'] / users, 4),
+                   f'recall@{k}': round(total['recall'] / users, 4),
+                   'coverage': round(len(total['songs']) / max(catalog_size, 1), 4),
+                   'empty_users': total['empty'],
+                   **percentiles(total['latencies'] or [0.0])}
+            for name, total in totals.items()}
+
+
+class Command(BaseCommand):
+    help = ('Loads a database dump into a scratch database, holds out a share of every user\'s ratings, '
+            'rebuilds the offline models on the rest and reports precision@k, recall@k, catalog coverage and '
+            'p50/p95/p99 latency of every recommendation engine as JSON. The held out ratings are restored '
+            'and the scratch database dropped unless --keep is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dump', default=DEFAULT_DUMP,
+                            help='Plain or custom format pg_dump file, e.g. ovatify_backup_15032024.sql')
+        parser.add_argument('--database', default='ovatify_evaluation', help='Name of the scratch database')
+        parser.add_argument('--no-load', action='store_true',
+                            help='Evaluate the configured database as it is instead of loading a dump')
+        parser.add_argument('--keep', action='store_true', help='Keep the scratch database')
+        parser.add_argument('--engines', type=lambda value: value.split(','), default=list(ENGINES),
+                            help=f'Comma separated engines out of {", ".join(ENGINES)}')
+        parser.add_argument('-k', type=int, default=10, help='Recommendations per user')
+        parser.add_argument('--holdout', type=float, default=0.2, help='Share of each user\'s ratings held out')
+        parser.add_argument('--min-ratings', type=int, default=5,
+                            help='Users with fewer ratings are not evaluated')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the hold out and the engines\' sampling')
+        parser.add_argument('--psql', default='psql', help='psql executable')
+        parser.add_argument('--pg-restore', default='pg_restore', help='pg_restore executable')
+        parser.add_argument('--output', default='-', help='JSON report file, - for stdout')
+
+    def handle(self, *args, **options):
+        unknown = set(options['engines']) - set(ENGINES)
+        if unknown:
+            raise CommandError(f'Unknown engines: {", ".join(sorted(unknown))}')
+        if options['k'] < 1 or not 0 < options['holdout'] < 1 or options['min_ratings'] < 2:
+            raise CommandError('-k must be positive, --holdout between 0 and 1 and --min-ratings at least 2')
+        if not options['no_load'] and not os.path.exists(options['dump']):
+            raise CommandError(f'{options["dump"]} does not exist')
+        log = (lambda line: self.stderr.write(line)) if options['output'] == '-' else self.stdout.write
+
+        if options['no_load']:
+            report = self.run(options, log)
+        else:
+            log(f'Loading {options["dump"]} into {options["database"]}')
+            with scratch_database(options['database'], options['dump'], options['psql'], options['pg_restore'],
+                                  options['keep']):
+                report = self.run(options, log)
+            report['dump'] = os.path.basename(options['dump'])
+
+        if options['output'] == '-':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+    def run(self, options, log):
+        engines = {name: ENGINES[name] for name in options['engines']}
+        rng = random.Random(options['seed'])
+        random.seed(options['seed'])
+        with transaction.atomic(), tempfile.TemporaryDirectory() as model_dir, \
+                override_settings(RECOMMENDER_MODEL_DIR=model_dir):
+            held_out = hold_out(options['holdout'], options['min_ratings'], rng)
+            if not held_out:
+                raise CommandError(f'No user has {options["min_ratings"]} ratings to hold some out')
+            # The offline models may only know of the ratings that are left
+            build_models(model_dir)
+            for model in (GENRE_SONG_INDEX, SEEN_SONGS, ITEM_NEIGHBOURS_MODEL, SONG_FEATURES):
+                model.reset()
+            log(f'Evaluating {len(engines)} engines for {len(held_out)} users')
+            results = evaluate(engines, held_out, options['k'], Song.objects.count(), log)
+            transaction.set_rollback(True)
+        for model in (GENRE_SONG_INDEX, SEEN_SONGS, ITEM_NEIGHBOURS_MODEL, SONG_FEATURES):
+            model.reset()
+        k = options['k']
+        for name, result in results.items():
+            log(f'  {name:<26} precision@{k}={result[f"precision@{k}"]:.4f}  recall@{k}={result[f"recall@{k}"]:.4f}  '
+                f'coverage={result["coverage"]:.4f}  p50={result["p50_ms"]:.2f} ms  p99={result["p99_ms"]:.2f} ms')
+        return {'k': k, 'holdout': options['holdout'], 'min_ratings': options['min_ratings'],
+                'seed': options['seed'], 'users': len(held_out), 'engines': results}
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.3 on 2026-10-18 10:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0015_playlist_playlistsong_playlist_songs_and_more'),
+        ('users', '0014_suggestionnotification'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usersongrating',
+            index=models.Index(fields=['user', '-rating', '-id'], name='usersongrating_user_rating'),
+        ),
+        migrations.AddIndex(
+            model_name='usersongrating',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='usersongrating_user_created'),
+        ),
+    ]
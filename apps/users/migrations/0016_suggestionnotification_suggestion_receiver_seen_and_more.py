@@ -0,0 +1,22 @@
+# Generated by Django 5.0.3 on 2026-10-18 10:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0015_playlist_playlistsong_playlist_songs_and_more'),
+        ('users', '0015_usersongrating_usersongrating_user_rating_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='suggestionnotification',
+            index=models.Index(fields=['receiver', 'is_seen', '-created_at'], name='suggestion_receiver_seen'),
+        ),
+        migrations.AddIndex(
+            model_name='suggestionnotification',
+            index=models.Index(fields=['receiver', '-created_at', '-id'], name='suggestion_receiver_created'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0016_suggestionnotification_suggestion_receiver_seen_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='rating_changes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
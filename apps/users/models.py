@@ -21,6 +21,9 @@ class User(CoreModel):
     friends = models.ManyToManyField("self", through="Friend",
                                      symmetrical=True,
                                      through_fields=("user", "friend"))
+    # Rating writes so far, compared against the count cached recommendation
+    # sections were computed at
+    rating_changes = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return str(self.username)
@@ -32,9 +35,29 @@ class UserSongRating(CoreModel):
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
     rating = models.DecimalField(max_digits=4, decimal_places=2)
 
+    class Meta(CoreModel.Meta):
+        indexes = [
+            models.Index(fields=['user', '-rating', '-id'], name='usersongrating_user_rating'),
+            models.Index(fields=['user', '-created_at', '-id'], name='usersongrating_user_created'),
+        ]
+
     def __str__(self):
         return f"{self.user.__str__()} - {self.song.__str__()}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from users.utils import invalidateUserLibraryCaches
+        from users.seen_songs import SEEN_SONGS
+        invalidateUserLibraryCaches(self.user_id)
+        SEEN_SONGS.update(self.user_id, self.song_id, self.is_active and not self.is_deleted)
+
+    def hard_delete(self):
+        super().hard_delete()
+        from users.utils import invalidateUserLibraryCaches
+        from users.seen_songs import SEEN_SONGS
+        invalidateUserLibraryCaches(self.user_id)
+        SEEN_SONGS.update(self.user_id, self.song_id, False)
+
 
 class UserPreferences(CoreModel):
     id = models.AutoField(primary_key=True)
@@ -97,5 +120,11 @@ class SuggestionNotification(CoreModel):
     song = models.ForeignKey(Song, on_delete=models.CASCADE)
     is_seen = models.BooleanField(default=False)
 
+    class Meta(CoreModel.Meta):
+        indexes = [
+            models.Index(fields=['receiver', 'is_seen', '-created_at'], name='suggestion_receiver_seen'),
+            models.Index(fields=['receiver', '-created_at', '-id'], name='suggestion_receiver_created'),
+        ]
+
     def __str__(self):
         return f"{self.receiver.username} - Suggested by {self.suggester.username} - {self.song.name}"
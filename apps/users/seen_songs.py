@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from songs.genre_index import GENRE_SONG_INDEX
+from users.models import UserSongRating
+
+# Users whose seen sets a process keeps, the least recently used go first.
+# A set takes up to one bit per catalog song (128KB at 1M songs), so this
+# bounds them to about 32MB per worker
+SEEN_SONGS_USERS = 256
+# Seconds a seen set is used before it is read again. Rating writes of the
+# own process update it right away, the ones of other processes after this
+SEEN_SONGS_REFRESH_SECONDS = 60
+# A recommendation draws at most this many times its limit in extra
+# candidates to make up for the seen ones it drops
+SEEN_OVERSAMPLING = 2
+
+
+class SeenSet:
+    # The songs a user rated as a bitset over the dense song positions of
+    # GENRE_SONG_INDEX, one bit per song up to the user's highest position
+    def __init__(self, positions, generation: int):
+        positions = np.asarray(positions, dtype=np.int64)
+        self.bits = np.zeros((int(positions.max(initial=-1)) + 8) // 8, dtype=np.uint8)
+        np.bitwise_or.at(self.bits, positions >> 3, np.left_shift(1, positions & 7).astype(np.uint8))
+        self.count = int(np.unpackbits(self.bits).sum())
+        self.generation = generation
+        self.built_at = time.monotonic()
+
+    def add(self, position: int):
+        byte, bit = position >> 3, np.uint8(1 << (position & 7))
+        if byte >= len(self.bits):
+            self.bits = np.concatenate([self.bits, np.zeros(max(byte + 1 - len(self.bits), len(self.bits) // 2),
+                                                            dtype=np.uint8)])
+        if not self.bits[byte] & bit:
+            self.bits[byte] |= bit
+            self.count += 1
+
+    def extra(self, limit: int):
+        # Extra candidates to draw so limit unseen songs are left when as many
+        # of the candidates as possible turn out to be seen
+        return min(self.count, SEEN_OVERSAMPLING * limit)
+
+    def unseen(self, song_ids):
+        # song_ids without the seen ones, in order. Songs without a position
+        # were never rated so they pass
+        positions = np.fromiter((GENRE_SONG_INDEX.positions.get(song_id, -1) for song_id in song_ids),
+                                dtype=np.int64, count=len(song_ids))
+        bits = self.bits
+        inside = (positions >= 0) & (positions < len(bits) * 8)
+        seen = np.zeros(len(positions), dtype=bool)
+        seen[inside] = (bits[positions[inside] >> 3] >> (positions[inside] & 7)) & 1 == 1
+        return [song_ids[i] for i in np.flatnonzero(~seen)]
+
+
+class SeenSongs:
+    # Per process cache of the users' seen sets, built from their ratings
+    # with one query
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.seen_sets = OrderedDict()
+
+    def get(self, userid):
+        with self.lock:
+            seen = self.seen_sets.get(str(userid))
+            if seen is not None:
+                self.seen_sets.move_to_end(str(userid))
+        if (seen is None or seen.generation != GENRE_SONG_INDEX.generation
+                or time.monotonic() - seen.built_at >= SEEN_SONGS_REFRESH_SECONDS):
+            generation = GENRE_SONG_INDEX.generation
+            # Read before songPositions, which holds the genre index lock
+            song_ids = list(UserSongRating.objects.filter(user=userid).values_list('song_id', flat=True))
+            seen = SeenSet(GENRE_SONG_INDEX.songPositions(song_ids), generation)
+            with self.lock:
+                self.seen_sets[str(userid)] = seen
+                self.seen_sets.move_to_end(str(userid))
+                while len(self.seen_sets) > SEEN_SONGS_USERS:
+                    self.seen_sets.popitem(last=False)
+        return seen
+
+    def update(self, userid, song_id: str, seen: bool):
+        # Called on rating writes. A removed rating drops the seen set, the
+        # user may have rated the song more than once
+        with self.lock:
+            seen_set = self.seen_sets.get(str(userid))
+            if seen_set is None:
+                return
+            if not seen or seen_set.generation != GENRE_SONG_INDEX.generation:
+                del self.seen_sets[str(userid)]
+                return
+            seen_set.add(GENRE_SONG_INDEX.songPositions([song_id])[0])
+
+
+SEEN_SONGS = SeenSongs()
@@ -19,6 +19,7 @@ urlpatterns = [
     path('get-songs-by-tempo/', view=views.user_songs_with_tempo, name='get-songs-tempo'),
     path('get-songs-by-artist/', view=views.user_songs_with_artist, name='get-songs-artist'),
     path('get-songs-by-mood/', view=views.user_songs_with_mood, name='get-songs-mood'),
+    path('get-songs-filtered/', view=views.user_songs_filtered, name='get-songs-filtered'),
     path('get-recently-added-songs/', view=views.get_recently_added_songs, name='get-recently-added-songs'),
     path('get-favorite-songs/', view=views.get_favorite_songs, name='get-favorite-songs'),
     path('get-favorite-genres/', view=views.get_favorite_genres, name='get-favorite-genres'),
@@ -46,6 +47,7 @@ urlpatterns = [
     path('recommend-since-you-like/', view=views.recommend_since_you_like, name='recommend-since-you-like'),
     path('recommend-friend-mix/', view=views.recommend_friend_mix, name='recommend-friend-mix'),
     path('recommend-friend-listen/', view=views.recommend_friend_listen, name='recommend-friend-listen'),
+    path('recommend-batch/', view=views.recommend_batch, name='recommend-batch'),
     path('export-by-genre/', views.export_by_genre, name='export-by-genre'),
     path('export-by-artist/', views.export_by_artist, name='export-by-artist'),
     path('get-library-artist-names/', views.get_library_artist_names, name='get-library-artist-names'),
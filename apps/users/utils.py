@@ -1,12 +1,26 @@
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import json
-
+import logging
 import math
 import random
+import time
+from datetime import datetime
+from decimal import Decimal
+from django.contrib.postgres.aggregates import ArrayAgg
 from django.core import serializers
+from django.core.cache import caches
+from django.db import connection
+from django.db.models import Count, Exists, F, OuterRef, Q, Window
+from django.db.models.functions import RowNumber
 
-from songs.models import Mood, Tempo, Genre, Song, Artist
-from users.models import User, FriendGroup
+from songs.models import Mood, Tempo, RecordedEnvironment, Genre, Song, Artist, GenreSong, ArtistSong
+from songs.genre_index import GENRE_SONG_INDEX
+from songs.song_features import SONG_FEATURES
+from songs.utils import serializeSongMinimum, serializeSongsMinimum, withSongRelations, encodeCursor, decodeCursor
+from users.item_neighbours import ITEM_NEIGHBOURS_MODEL
+from users.models import User, FriendGroup, UserSongRating, SuggestionNotification
+from users.seen_songs import SEEN_SONGS
 
 
 def getFavoriteSongs(userid: str, number_of_songs: int):
@@ -19,98 +33,280 @@ def getFavoriteSongs(userid: str, number_of_songs: int):
         user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at')[
                              :number_of_songs]
     songs = [song_rating.song for song_rating in user_songs_ratings]
-    serialized_songs = [
-        {
-            'id': song.id,
-            'name': song.name,
-            'release_year': song.release_year,
-            'main_artist': song.artists.first().name if song.artists.exists() else "Unknown",
-            'img_url': song.img_url
-        }
-        for song in songs
-    ]
+    serialized_songs = serializeSongsMinimum(songs, default_artist="Unknown")
     return serialized_songs
 
 
+TASTE_FACETS = ('genres', 'artists', 'moods', 'tempos')
+# Top rated songs taken from each friend for friend based recommendations
+FRIEND_SAMPLE_SIZE = 10
+# Candidates per recommendation sampled by get_recommendations when they are ranked by taste
+TASTE_OVERSAMPLING = 4
+
+
+def getTopRatings(user_ids, number_of_songs: int):
+    # Each user's top `number_of_songs` ratings, ranked inside the database
+    ratings = UserSongRating.objects.filter(user_id__in=user_ids)
+    if number_of_songs == -1:
+        return ratings
+    return ratings.annotate(
+        rank=Window(RowNumber(),
+                    partition_by=[F('user_id')],
+                    order_by=[F('rating').desc(), F('updated_at').desc()])
+    ).filter(rank__lte=number_of_songs)
+
+
+def getFriendsWithConsent(userid: str):
+    # The user's friends with their consent flags, in one join. Friends who
+    # never saved their preferences get None for both flags
+    return list(User.objects.filter(friend__user_id=userid).values(
+        'id', 'username', 'img_url',
+        data_sharing_consent=F('userpreferences__data_sharing_consent'),
+        data_processing_consent=F('userpreferences__data_processing_consent'),
+    ))
+
+def getTasteHistograms(userids, number_of_songs: int = -1, facets=TASTE_FACETS):
+    # Genre, artist, mood and tempo counts over the top `number_of_songs`
+    # rated songs (-1 for all) of a user, or of each user in a list of users.
+    # Everything comes from one query grouped by rating, M2M names are
+    # collected with ARRAY_AGG. Lists are ordered like Counter.most_common()
+    single_user = isinstance(userids, str)
+    user_ids = [userids] if single_user else list(userids)
+
+    ratings = UserSongRating.objects.filter(user_id__in=user_ids)
+    if number_of_songs != -1:
+        ratings = ratings.filter(id__in=getTopRatings(user_ids, number_of_songs).values('id'))
+
+    fields = ['id', 'user_id']
+    aggregates = {}
+    if 'moods' in facets:
+        fields.append('song__mood')
+    if 'tempos' in facets:
+        fields.append('song__tempo')
+    if 'genres' in facets:
+        aggregates['genre_names'] = ArrayAgg('song__genres__name', distinct=True,
+                                             filter=Q(song__genres__isnull=False))
+    if 'artists' in facets:
+        aggregates['artist_names'] = ArrayAgg('song__artists__name', distinct=True,
+                                              filter=Q(song__artists__isnull=False))
+    rows = ratings.values(*fields).annotate(**aggregates)\
+                  .order_by('-rating', '-updated_at')
+
+    counters = {user_id: {facet: Counter() for facet in facets} for user_id in user_ids}
+    for row in rows:
+        counts = counters[row['user_id']]
+        if 'genres' in facets:
+            counts['genres'].update(row['genre_names'] or [])
+        if 'artists' in facets:
+            counts['artists'].update(row['artist_names'] or [])
+        if 'moods' in facets:
+            counts['moods'][Mood(row['song__mood']).label] += 1
+        if 'tempos' in facets:
+            counts['tempos'][Tempo(row['song__tempo']).label] += 1
+
+    histograms = {user_id: {facet: counter.most_common() for facet, counter in counts.items()}
+                  for user_id, counts in counters.items()}
+    if single_user:
+        return histograms[userids]
+    return histograms
+
+
 def getFavoriteGenres(userid: str, number_of_songs: int):
     if number_of_songs < -1 or number_of_songs == 0:
         return None
-    user = User.objects.get(id=userid)
-    if number_of_songs == -1:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at').all()
-    else:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at')[
-                             :number_of_songs]
-    songs = [song_rating.song for song_rating in user_songs_ratings]
-    genre_counts = Counter()
-    for song in songs:
-        song_genre_table = song.genresong_set.prefetch_related('genre').all()
-        all_genres = [genre_song.genre for genre_song in song_genre_table]
-        for genre in all_genres:
-            genre_counts[genre.name] += 1
-    genre_counts = genre_counts.most_common()
-    return genre_counts  # returns a list of genre names and their counts, we can call
-    # .most_common() on genre_counts to get the most common genres
+    return getTasteHistograms(userid, number_of_songs, facets=('genres',))['genres']
+    # returns a list of genre names and their counts, most common first
 
 
 def getFavoriteArtists(userid: str, number_of_songs: int):
     if number_of_songs < -1 or number_of_songs == 0:
         return None
-    user = User.objects.get(id=userid)
-    if number_of_songs == -1:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at').all()
-    else:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at')[
-                             :number_of_songs]
-    songs = [song_rating.song for song_rating in user_songs_ratings]
-    artist_counts = Counter()
-    for song in songs:
-        song_artist_table = song.artistsong_set.prefetch_related('artist').all()
-        all_artists = [artist_song.artist for artist_song in song_artist_table]
-        for artist in all_artists:
-            artist_counts[artist.name] += 1
-    artist_counts = artist_counts.most_common()
-    return artist_counts  # returns a list of artist names and their counts, we can call
-    # .most_common() on artist_counts to get the most common artists
+    return getTasteHistograms(userid, number_of_songs, facets=('artists',))['artists']
 
 
 def getFavoriteMoods(userid: str, number_of_songs: int):
     if number_of_songs < -1 or number_of_songs == 0:
         return None
-    user = User.objects.get(id=userid)
-    if number_of_songs == -1:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at').all()
-    else:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at')[
-                             :number_of_songs]
-    songs = [song_rating.song for song_rating in user_songs_ratings]
-    mood_counts = Counter()
-    for song in songs:
-        mood_label = Mood(song.mood).label
-        mood_counts[mood_label] += 1
-    mood_counts = mood_counts.most_common()
-    return mood_counts  # returns a list of mood names and their counts, we can call
-    # .most_common(n) on mood_counts to get the most common n moods
+    return getTasteHistograms(userid, number_of_songs, facets=('moods',))['moods']
 
 
 def getFavoriteTempos(userid: str, number_of_songs: int):
     if number_of_songs < -1 or number_of_songs == 0:
         return None
-    user = User.objects.get(id=userid)
-    if number_of_songs == -1:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating',
-                                                                                       '-updated_at').all()
+    return getTasteHistograms(userid, number_of_songs, facets=('tempos',))['tempos']
+
+
+# order name -> (sort field, parser for the cursor value), always descending
+# with the rating id as tie breaker to match the user_id composite indexes
+LIBRARY_ORDERINGS = {
+    'rating': ('rating', Decimal),
+    'recent': ('created_at', datetime.fromisoformat),
+}
+
+
+def getUserLibrary(userid: str, genre_name=None, artist_name=None, tempo_name=None, mood_name=None,
+                   order='rating', cursor=None, number_of_songs=10):
+    # Songs rated by the user matching every given filter, one page at a time.
+    # Filtering, ordering and the keyset page are all done by the database so
+    # the cost of a page does not depend on the size of the library.
+    # Returns the songs and the cursor of the next page (None on the last one)
+    if order not in LIBRARY_ORDERINGS:
+        raise ValueError('Invalid order')
+    field = LIBRARY_ORDERINGS[order][0]
+    ratings = UserSongRating.objects.filter(user_id=userid)
+    if genre_name is not None:
+        ratings = ratings.filter(Exists(GenreSong.objects.filter(song_id=OuterRef('song_id'),
+                                                                 genre__name=genre_name)))
+    if artist_name is not None:
+        ratings = ratings.filter(Exists(ArtistSong.objects.filter(song_id=OuterRef('song_id'),
+                                                                  artist__name=artist_name)))
+    if tempo_name is not None:
+        tempo = {label: value for value, label in Tempo.choices}.get(tempo_name)
+        ratings = ratings.filter(song__tempo=tempo)
+    if mood_name is not None:
+        mood = {label: value for value, label in Mood.choices}.get(mood_name)
+        ratings = ratings.filter(song__mood=mood)
+    if cursor is not None:
+        value, rating_id = decodeCursor(cursor, LIBRARY_ORDERINGS[order][1])
+        ratings = ratings.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': rating_id}))
+    page = list(ratings.select_related('song').order_by(f'-{field}', '-id')[:number_of_songs + 1])
+    next_cursor = None
+    if len(page) > number_of_songs:
+        page = page[:number_of_songs]
+        next_cursor = encodeCursor(getattr(page[-1], field), page[-1].id)
+    return [rating.song for rating in page], next_cursor
+
+
+
+LIBRARY_FACETS_CACHE_TIMEOUT = 60 * 60
+
+
+def libraryFacetsCacheKey(userid: str):
+    return f'library_facets:{userid}'
+
+
+# Cached recommendation sections are fresh for RECOMMENDATION_FRESH_SECONDS
+# or until the user wrote RECOMMENDATION_RATING_CHANGES ratings. Stale
+# sections are still served while a RECOMMENDATION_EXECUTOR thread
+# recomputes them, for up to RECOMMENDATION_CACHE_TIMEOUT. Sections and
+# refresh locks are in the shared cache, the rating writes are counted on
+# the user's row, so writes handled by any worker count and none are lost
+RECOMMENDATION_FRESH_SECONDS = 15 * 60
+RECOMMENDATION_CACHE_TIMEOUT = 24 * 60 * 60
+RECOMMENDATION_RATING_CHANGES = 5
+RECOMMENDATION_REFRESH_LOCK_SECONDS = 60
+RECOMMENDATION_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='recommendations')
+
+
+def recommendationsCacheKey(userid: str, name: str, count: int):
+    return f'recommendations:{name}:{userid}:{count}'
+
+
+def invalidateUserLibraryCaches(userid: str):
+    # Called whenever one of the user's ratings is added, edited or deleted.
+    # Rating writes are counted rather than dropping the recommendations, a
+    # single rating hardly changes them
+    caches['shared'].delete(libraryFacetsCacheKey(userid))
+    User.objects.filter(id=userid).update(rating_changes=F('rating_changes') + 1)
+
+
+def cachedRecommendations(userid: str, name: str, count: int, compute):
+    # compute(userid, count) returns {'items': ..., 'error': ...} like
+    # get_recommendations; results without items are not cached
+    key = recommendationsCacheKey(userid, name, count)
+    rating_changes = User.objects.filter(id=userid).values_list('rating_changes', flat=True).first()
+    entry = caches['shared'].get(key)
+    if entry is None:
+        return storeRecommendations(key, compute(userid, count), rating_changes)
+    # An entry whose count is missing or ahead of the user's is stale too
+    stale = (time.time() - entry['computed_at'] >= RECOMMENDATION_FRESH_SECONDS
+             or rating_changes is None or entry.get('rating_changes') is None
+             or not 0 <= rating_changes - entry['rating_changes'] < RECOMMENDATION_RATING_CHANGES)
+    if stale and caches['shared'].add(f'{key}:refreshing', True, RECOMMENDATION_REFRESH_LOCK_SECONDS):
+        RECOMMENDATION_EXECUTOR.submit(refreshRecommendations, key, userid, count, compute, rating_changes)
+    return entry['result']
+
+
+def storeRecommendations(key: str, result, rating_changes):
+    if result['items'] is None:
+        caches['shared'].delete(key)
     else:
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at')[
-                             :number_of_songs]
-    songs = [song_rating.song for song_rating in user_songs_ratings]
-    tempo_counts = Counter()
-    for song in songs:
-        tempo_label = Tempo(song.tempo).label
-        tempo_counts[tempo_label] += 1
-    tempo_counts = tempo_counts.most_common()
-    return tempo_counts  # returns a list of tempo names and their counts, we can call
-    # .most_common(n) on tempo_counts to get the most common n tempos
+        caches['shared'].set(key, {'result': result, 'computed_at': time.time(), 'rating_changes': rating_changes},
+                             RECOMMENDATION_CACHE_TIMEOUT)
+    return result
+
+
+def refreshRecommendations(key: str, userid: str, count: int, compute, rating_changes):
+    # Runs in a RECOMMENDATION_EXECUTOR thread, which has its own database connection
+    try:
+        storeRecommendations(key, compute(userid, count), rating_changes)
+    except Exception:
+        logging.exception(f"Refreshing {key} failed")
+    finally:
+        caches['shared'].delete(f'{key}:refreshing')
+        connection.close()
+
+
+def getLibraryFacets(userid: str):
+    # Distinct artist and genre names in the user's library with the number of
+    # rated songs for each, most common first. One GROUP BY query per facet,
+    # cached in the shared cache until the user's ratings change, so a write
+    # handled by one worker is seen by all of them. The shared cache holds
+    # entries for far more users than are active, see its MAX_ENTRIES
+    key = libraryFacetsCacheKey(userid)
+    facets = caches['shared'].get(key)
+    if facets is not None:
+        return facets
+    ratings = UserSongRating.objects.filter(user_id=userid).order_by()
+    facets = {}
+    for facet, relation in (('artists', 'song__artists'), ('genres', 'song__genres')):
+        rows = ratings.filter(**{f'{relation}__is_deleted': False}) \
+            .values(name=F(f'{relation}__name')) \
+            .annotate(count=Count('song_id', distinct=True)) \
+            .order_by('-count', 'name')
+        facets[facet] = [(row['name'], row['count']) for row in rows]
+    caches['shared'].set(key, facets, LIBRARY_FACETS_CACHE_TIMEOUT)
+    return facets
+
+def getSuggestionInbox(user: User, number_of_suggestions=20, cursor=None):
+    # Newest first page of the suggestions a user received and the next cursor
+    notifications = SuggestionNotification.objects.filter(receiver=user)
+    if cursor is not None:
+        created_at, notification_id = decodeCursor(cursor, datetime.fromisoformat)
+        notifications = notifications.filter(Q(created_at__lt=created_at) |
+                                             Q(created_at=created_at, id__lt=notification_id))
+    page = list(notifications.select_related('suggester', 'song')
+                .order_by('-created_at', '-id')[:number_of_suggestions + 1])
+    next_cursor = None
+    if len(page) > number_of_suggestions:
+        page = page[:number_of_suggestions]
+        next_cursor = encodeCursor(page[-1].created_at, page[-1].id)
+    return page, next_cursor
+
+
+def serializeSuggestion(notification: SuggestionNotification):
+    return {
+        'id': notification.id,
+        'suggester_name': notification.suggester.username,
+        'suggester_img_url': notification.suggester.img_url,
+        'song_id': notification.song.id,
+        'song_img_url': notification.song.img_url,
+        'song_name': notification.song.name
+    }
+
+def serializeLibrarySong(song: Song):
+    return {
+        'id': song.id,
+        'name': song.name,
+        'release_year': song.release_year,
+        'duration': song.duration.total_seconds(),  # Convert DurationField to seconds
+        'tempo': Tempo(song.tempo).label,
+        'mood': Mood(song.mood).label,
+        'recorded_environment': RecordedEnvironment(song.recorded_environment).label,
+        'replay_count': song.replay_count,
+        'version': song.version,
+        'img_url': song.img_url
+    }
 
 def recommendation_creator(spotify_recommendations):
     tracks_info = []
@@ -139,96 +335,106 @@ def recommendation_creator(spotify_recommendations):
     return tracks_info
 
 
+def recommendationIds(seed_artists=None,
+                      seed_tracks=None,
+                      seed_genres=None,
+                      limit=10,
+                      taste=None,
+                      seen=None):
+    # Song ids for get_recommendations, the caller serializes them. With a
+    # taste vector from SONG_FEATURES.tasteVector the seeds yield more
+    # candidates, of which the ones closest to the taste are kept instead of
+    # a random pick. With the user's SeenSet from SEEN_SONGS the songs the
+    # user rated are dropped, the seeds yielding enough extra candidates
+    if (seed_artists is None
+            and seed_tracks is None
+            and seed_genres is None):
+        return {"ids": None,
+                "error": "Invalid parameters"}
+
+    valid_seeds = {"seed_artists": seed_artists,
+                   "seed_tracks": seed_tracks,
+                   "seed_genres": seed_genres}
+
+    for key in list(valid_seeds):
+        if valid_seeds[key] is None:
+            del valid_seeds[key]
+
+    # Songs are picked as ids from the in-memory genre index, the caller
+    # fetches them in one batch
+    recommendations = []
+    oversampling = TASTE_OVERSAMPLING if taste is not None else 1.5
+    extra = seen.extra(limit) if seen is not None else 0
+    per_type_limit = math.ceil((limit * oversampling + extra) / len(valid_seeds))
+    for key in valid_seeds:
+        if key == "seed_genres":
+            per_genre_limit = math.ceil(per_type_limit / len(valid_seeds[key]))
+            for seed_genre in valid_seeds[key]:
+                genre_id = GENRE_SONG_INDEX.genreId(seed_genre)
+                if genre_id is None:
+                    return {"ids": None,
+                            "error": f"Invalid genre name: {seed_genre}"}
+                recommendations.extend(GENRE_SONG_INDEX.sample(genre_id, per_genre_limit))
+        elif key == "seed_artists":
+            per_artist_limit = math.ceil(per_type_limit / len(valid_seeds[key]))
+            for seed_artist in valid_seeds[key]:
+                # The first genre of the artist's first song
+                db_artist = (Artist.objects.filter(name__iexact=seed_artist)
+                             .order_by('id', 'song__id', 'song__genres')
+                             .values_list('id', 'song__genres').first())
+                if db_artist is None:
+                    return {"ids": None,
+                            "error": f"Invalid artist name: {seed_artist}"}
+                artist_genre = db_artist[1]
+                if artist_genre is None:
+                    continue
+                recommendations.extend(GENRE_SONG_INDEX.sample(artist_genre, per_artist_limit))
+        elif key == "seed_tracks":
+            if len(valid_seeds[key]) == 0:
+                per_track_limit = math.ceil(per_type_limit / len(valid_seeds))
+            else:
+                per_track_limit = math.ceil(per_type_limit / len(valid_seeds[key]))
+
+            if len(valid_seeds[key]) == 0:
+                recommendations.extend(GENRE_SONG_INDEX.sampleSongs(per_track_limit))
+            for seed_track in valid_seeds[key]:
+                db_track = (Song.objects.filter(id=seed_track).order_by('genres')
+                            .values_list('id', 'genres').first())
+                if db_track is None:
+                    return {"ids": None,
+                            "error": f"Invalid track id: {seed_track}"}
+                track_genre = db_track[1]
+                if track_genre is None:
+                    continue
+                recommendations.extend(GENRE_SONG_INDEX.sample(track_genre, per_track_limit))
+
+    recommendations = list(set(recommendations))
+    if seen is not None:
+        recommendations = seen.unseen(recommendations)
+
+    if taste is not None:
+        recommendations = SONG_FEATURES.rank(recommendations, taste)[:limit]
+    elif len(recommendations) > limit:
+        recommendations = random.sample(list(recommendations), limit)
+
+    return {"ids": recommendations, "error": None}
+
+
 def get_recommendations(seed_artists=None,
                         seed_tracks=None,
                         seed_genres=None,
                         limit=10,
-                        lower_limit=0):
+                        lower_limit=0,
+                        taste=None,
+                        seen=None):
     try:
-        if (seed_artists is None
-                and seed_tracks is None
-                and seed_genres is None):
+        recommendations = recommendationIds(seed_artists, seed_tracks, seed_genres, limit, taste, seen)
+        if recommendations['ids'] is None:
             return {"items": None,
-                    "error": "Invalid parameters"}
-
-        valid_seeds = {"seed_artists": seed_artists,
-                       "seed_tracks": seed_tracks,
-                       "seed_genres": seed_genres}
-
-        for key in list(valid_seeds):
-            if valid_seeds[key] is None:
-                del valid_seeds[key]
-
-        recommendations = []
-        per_type_limit = math.ceil((limit * 1.5) / len(valid_seeds))
-        for key in valid_seeds:
-            if key == "seed_genres":
-                per_genre_limit = math.ceil(per_type_limit / len(valid_seeds[key]))
-                for seed_genre in valid_seeds[key]:
-                    db_genre = Genre.objects.filter(name__iexact=seed_genre).first()
-                    if db_genre is None:
-                        return {"items": None,
-                                "error": f"Invalid genre name: {seed_genre}"}
-                    ids = db_genre.song_set.values_list('id', flat=True)
-                    if len(ids) > per_genre_limit:
-                        ids = random.sample(list(ids), per_genre_limit)
-                    random_songs_genre = Song.objects.filter(id__in=ids)
-                    recommendations.extend(random_songs_genre)
-            elif key == "seed_artists":
-                per_artist_limit = math.ceil(per_type_limit / len(valid_seeds[key]))
-                for seed_artist in valid_seeds[key]:
-                    db_artist = Artist.objects.filter(name__iexact=seed_artist).first()
-                    if db_artist is None:
-                        return {"items": None,
-                                "error": f"Invalid artist name: {seed_artist}"}
-                    artist_genre = db_artist.song_set.first().genres.first()
-                    if artist_genre is None:
-                        continue
-                    ids = artist_genre.song_set.values_list('id', flat=True)
-                    if len(ids) > per_artist_limit:
-                        ids = random.sample(list(ids), per_artist_limit)
-                    random_songs_artist = Song.objects.filter(id__in=ids)
-                    recommendations.extend(random_songs_artist)
-            elif key == "seed_tracks":
-                if len(valid_seeds[key]) == 0:
-                    per_track_limit = math.ceil(per_type_limit / len(valid_seeds))
-                else:
-                    per_track_limit = math.ceil(per_type_limit / len(valid_seeds[key]))
-
-                if len(valid_seeds[key]) == 0:
-                    song_ids = Song.objects.all().values_list('id', flat=True)
-                    random_ids = random.sample(list(song_ids), per_track_limit)
-                    random_songs = Song.objects.filter(id__in=random_ids)
-                    recommendations.extend(random_songs)
-                for seed_track in valid_seeds[key]:
-                    db_track = Song.objects.filter(id=seed_track).first()
-                    if db_track is None:
-                        return {"items": None,
-                                "error": f"Invalid track id: {seed_track}"}
-                    track_genre = db_track.genres.first()
-                    if track_genre is None:
-                        continue
-                    ids = track_genre.song_set.values_list('id', flat=True)
-                    if len(ids) > per_track_limit:
-                        ids = random.sample(list(ids), per_track_limit)
-                    random_songs_track = Song.objects.filter(id__in=ids)
-                    recommendations.extend(random_songs_track)
-
-        recommendations = list(set(recommendations))
-
-        if len(recommendations) > limit:
-            recommendations = random.sample(list(recommendations), limit)
-
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'main_artist': song.artists.first().name if song.artists.exists() else "Unknown",
-                'img_url': song.img_url
-            }
-            for song in recommendations
-        ]
+                    "error": recommendations['error']}
+
+        serialized_songs = serializeSongsMinimum(recommendations['ids'],
+                                                 default_artist="Unknown")
 
         if len(serialized_songs) < lower_limit:
             return {"items": serialized_songs,
@@ -240,6 +446,176 @@ def get_recommendations(seed_artists=None,
                 "error": f"Unknown Error: {e}"}
 
 
+def getSinceYouLike(userid: str, count: int):
+    # One section per favorite genre and artist (two of each) among the
+    # user's 20 top rated songs, ranked by the user's taste
+    ratings = list(UserSongRating.objects.filter(user=userid).order_by('-rating')
+                   .values_list('song_id', 'rating')[:20])
+    taste = SONG_FEATURES.tasteVector(ratings)
+    seen = SEEN_SONGS.get(userid)
+    histograms = getTasteHistograms(userid, 20, facets=('genres', 'artists'))
+    genres = [name for name, _ in histograms['genres']]
+    if len(genres) < 2:
+        return {"items": None,
+                "error": "No genre found for the user, cannot make recommendation"}
+    artists = [name for name, _ in histograms['artists']]
+    if len(artists) < 2:
+        return {"items": None,
+                "error": "No artist found for the user, cannot make recommendation"}
+
+    sections = {}
+    for key, names in (('seed_genres', genres[:2]), ('seed_artists', artists[:2])):
+        for name in names:
+            recommendations = get_recommendations(**{key: [name]}, limit=count, taste=taste, seen=seen)
+            if recommendations['items'] is None:
+                return recommendations
+            sections[name.title()] = recommendations['items']
+    return {"items": sections, "error": None}
+
+
+# Sections of a recommendation batch, the seeded ones take a list of seeds
+RECOMMENDATION_SECTION_TYPES = ('tracks', 'genres', 'artists', 'you_might_like', 'since_you_like',
+                                'friend_mix', 'friend_listen')
+SEEDED_SECTION_TYPES = {'tracks': 'seed_tracks', 'genres': 'seed_genres', 'artists': 'seed_artists'}
+RECOMMENDATION_BATCH_SECTIONS = 10
+SECTION_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='recommendation-section')
+
+
+def parseRecommendationSections(sections):
+    # Validated copies of the section specs of a batch, ValueError otherwise
+    if not isinstance(sections, list) or not 1 <= len(sections) <= RECOMMENDATION_BATCH_SECTIONS:
+        raise ValueError(f'sections must be a list of 1 to {RECOMMENDATION_BATCH_SECTIONS} sections')
+    parsed = []
+    for index, section in enumerate(sections):
+        if not isinstance(section, dict) or section.get('type') not in RECOMMENDATION_SECTION_TYPES:
+            raise ValueError(f'Section {index} has an invalid type')
+        count = section.get('count', 10)
+        if not isinstance(count, int) or not 1 <= count <= 100:
+            raise ValueError(f'Section {index} has an invalid count')
+        seeds = section.get('seeds')
+        if section['type'] in SEEDED_SECTION_TYPES and (
+                not isinstance(seeds, list) or not seeds or not all(isinstance(seed, str) for seed in seeds)):
+            raise ValueError(f'Section {index} needs a list of seeds')
+        parsed.append({'name': str(section.get('name', section['type'])), 'type': section['type'],
+                       'count': count, 'seeds': seeds})
+    return parsed
+
+
+class RecommendationContext:
+    # The user's data shared by the sections of a batch. load() reads what
+    # the requested section types need once, before the sections run, so the
+    # sections only read it
+    def __init__(self, userid: str):
+        self.userid = userid
+        self.ratings = []
+        self.taste = None
+        self.seen = None
+        self.friend_song_ids = None
+
+    def load(self, section_types):
+        if section_types & {'you_might_like', 'friend_mix', *SEEDED_SECTION_TYPES}:
+            self.seen = SEEN_SONGS.get(self.userid)
+        if section_types & {'you_might_like', *SEEDED_SECTION_TYPES}:
+            self.ratings = list(UserSongRating.objects.filter(user=self.userid).order_by('-rating')
+                                .values_list('song_id', 'rating')[:20])
+            self.taste = SONG_FEATURES.tasteVector(self.ratings)
+        if section_types & {'friend_mix', 'friend_listen'}:
+            friends = [friend['id'] for friend in getFriendsWithConsent(self.userid)
+                       if friend['data_processing_consent']]
+            if friends:
+                self.friend_song_ids = list(dict.fromkeys(
+                    getTopRatings(friends, FRIEND_SAMPLE_SIZE).values_list('song_id', flat=True)))
+
+
+def youMightLikeIds(context: RecommendationContext, count: int):
+    # Item neighbours, then song features, then the genres of rated songs.
+    # The models only know of the top rated songs, the seen set drops the
+    # other rated ones
+    extra = context.seen.extra(count) if context.seen is not None else 0
+    song_ids = (ITEM_NEIGHBOURS_MODEL.recommend(context.ratings, count + extra)
+                or SONG_FEATURES.recommend(context.ratings, count + extra))
+    if song_ids:
+        if context.seen is not None:
+            song_ids = context.seen.unseen(song_ids)
+        return {"ids": song_ids[:count], "error": None}
+    seeds = list(dict.fromkeys(song_id for song_id, _ in context.ratings))
+    return recommendationIds(seed_tracks=random.sample(seeds, min(len(seeds), 5)), limit=count,
+                             seen=context.seen)
+
+
+def friendSongIds(context: RecommendationContext, count: int, mix: bool):
+    if context.friend_song_ids is None:
+        return {"ids": None,
+                "error": "No friends found for the user, cannot make recommendation"}
+    if not context.friend_song_ids:
+        return {"ids": None,
+                "error": "No songs found for friends, cannot make recommendation"}
+    if mix:
+        seeds = random.sample(context.friend_song_ids, min(len(context.friend_song_ids), 5))
+        return recommendationIds(seed_tracks=seeds, limit=count, seen=context.seen)
+    return {"ids": random.sample(context.friend_song_ids, min(len(context.friend_song_ids), count)),
+            "error": None}
+
+
+def recommendationSection(context: RecommendationContext, section):
+    # Song ids of a section, or already serialized items for since_you_like
+    kind, count = section['type'], section['count']
+    if kind in SEEDED_SECTION_TYPES:
+        return recommendationIds(**{SEEDED_SECTION_TYPES[kind]: section['seeds']}, limit=count,
+                                 taste=context.taste, seen=context.seen)
+    if kind == 'you_might_like':
+        return youMightLikeIds(context, count)
+    if kind == 'since_you_like':
+        return cachedRecommendations(context.userid, 'since_you_like', count, getSinceYouLike)
+    return friendSongIds(context, count, mix=kind == 'friend_mix')
+
+
+def runRecommendationSection(context: RecommendationContext, section):
+    # Runs in a SECTION_EXECUTOR thread, which has its own database connection
+    try:
+        return recommendationSection(context, section)
+    except Exception as e:
+        logging.exception(f"Recommendation section {section['name']} failed")
+        return {"items": None, "error": f"Unknown Error: {e}"}
+    finally:
+        connection.close()
+
+
+def getRecommendationBatch(userid: str, sections):
+    # Computes the parsed sections concurrently on top of one context, then
+    # fetches the songs of all of them in one batch
+    context = RecommendationContext(userid)
+    context.load({section['type'] for section in sections})
+    futures = [SECTION_EXECUTOR.submit(runRecommendationSection, context, section) for section in sections]
+    results = [future.result() for future in futures]
+
+    song_ids = {song_id for result in results for song_id in result.get('ids') or []}
+    songs = {song.id: song for song in withSongRelations(list(song_ids), 'artists')}
+    batch = []
+    for section, result in zip(sections, results):
+        entry = {'name': section['name'], 'type': section['type']}
+        if result.get('ids') is not None:
+            entry['tracks_info'] = [serializeFriendListenSong(songs[song_id]) if section['type'] == 'friend_listen'
+                                    else serializeSongMinimum(songs[song_id], default_artist="Unknown")
+                                    for song_id in result['ids'] if song_id in songs]
+        elif result.get('items') is not None:
+            entry['tracks_info'] = result['items']
+        else:
+            entry['error'] = result['error']
+        batch.append(entry)
+    return batch
+
+
+def serializeFriendListenSong(song: Song):
+    return {
+        'name': song.name,
+        'main_artist': [artist.name for artist in song.artists.all()],
+        'release_year': song.release_year,
+        'id': song.id,
+        'img_url': song.img_url,
+    }
+
+
 def serializeFriendGroupSimple(friend_group: FriendGroup):
     return {
         'id': friend_group.id,
@@ -12,7 +12,8 @@ from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from OVTF_Backend.firebase_auth import token_required
 import spotipy
-from songs.utils import serializePlaylist, serializePlaylistInfo
+from songs.utils import (serializePlaylist, serializePlaylistInfo, serializePlaylistsInfo,
+                         serializeSongsMinimum, serializeSongsExtended, withSongRelations)
 from users.utils import recommendation_creator, serializeFriendGroupSimple, serializeFriendGroupExtended
 from songs.models import (Playlist, Song,
                           Genre, Mood, Tempo,
@@ -27,7 +28,24 @@ from users.models import (SuggestionNotification, User, UserPreferences,
                           FriendRequest,
                           RequestStatus, FriendGroup,
                           )
+from users.seen_songs import SEEN_SONGS
 from users.utils import (get_recommendations,
+                         getRecommendationBatch,
+                         RecommendationContext,
+                         youMightLikeIds,
+                         parseRecommendationSections,
+                         serializeFriendListenSong,
+                         getSinceYouLike,
+                         cachedRecommendations,
+                         getTasteHistograms,
+                         getUserLibrary,
+                         getFriendsWithConsent,
+                         getTopRatings,
+                         FRIEND_SAMPLE_SIZE,
+                         getLibraryFacets,
+                         getSuggestionInbox,
+                         serializeSuggestion,
+                         serializeLibrarySong,
                          getFavoriteGenres,
                          getFavoriteSongs,
                          getFavoriteArtists,
@@ -381,103 +399,46 @@ def delete_song_rating(request, userid):
         return JsonResponse({'error': 'An unexpected error occurred'}, status=500)
 
 
-@csrf_exempt
-@token_required
-def user_songs_with_genre(request, userid):
-    if request.method != 'GET':
-        return HttpResponse(status=405)
+def filtered_library_response(request, userid, **filters):
     try:
         data = request.GET
-        number_of_songs: int = data.get('number_of_songs', 10)
-        number_of_songs = int(number_of_songs)
-        genre_name: str = data.get('genre_name')
-        if genre_name is None:  # if Genre Name is not provided
-            return HttpResponse(status=400)
-        genre_name = genre_name.title()
+        number_of_songs = int(data.get('number_of_songs', 10))
         user = User.objects.get(id=userid)
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').all()[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]  # Get the song objects from the ratings
-        matching_songs = []
-        for song in songs:
-            song_genre_table = song.genresong_set.prefetch_related('genre').all()
-            all_genres = [genre_song.genre for genre_song in song_genre_table]
-            for genre in all_genres:
-                if genre.name == genre_name:
-                    matching_songs.append(song)
-                    break
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'duration': song.duration.total_seconds(),  # Convert DurationField to seconds
-                'tempo':  Tempo(song.tempo).label,
-                'mood': Mood(song.mood).label,
-                'recorded_environment': RecordedEnvironment(song.recorded_environment).label,
-                'replay_count': song.replay_count,
-                'version': song.version,
-                'img_url': song.img_url
-            }
-            for song in matching_songs
-        ]
-        return JsonResponse({'songs': serialized_songs}, status=200)
+        if number_of_songs < 1:
+            raise ValueError('Invalid number of songs')
+        songs, next_cursor = getUserLibrary(user.id, order=data.get('order', 'rating'),
+                                            cursor=data.get('cursor'), number_of_songs=number_of_songs,
+                                            **filters)
+        serialized_songs = [serializeLibrarySong(song) for song in songs]
+        return JsonResponse({'songs': serialized_songs, 'next_cursor': next_cursor}, status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
-    except ValueError:
-        return JsonResponse({'error': 'Invalid number of songs'}, status=400)
+    except ValueError as e:
+        return JsonResponse({'error': str(e) or 'Invalid number of songs'}, status=400)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @csrf_exempt
 @token_required
-def user_songs_with_artist(request, userid):
+def user_songs_with_genre(request, userid):
     if request.method != 'GET':
         return HttpResponse(status=405)
-    try:
-        data = request.GET
-        number_of_songs: int = data.get('number_of_songs', 10)
-        number_of_songs = int(number_of_songs)
-        artist_name: str = data.get('artist_name')
-        if artist_name is None:  # if Artist Name is not provided
-            return HttpResponse(status=400)
-        artist_name = artist_name.title()
-        user = User.objects.get(id=userid)
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').all()[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]  # Get the song objects from the ratings
-        matching_songs = []
-        for song in songs:
-            song_artist_table = song.artistsong_set.prefetch_related('artist').all()
-            all_artists = [artist_song.artist for artist_song in song_artist_table]
-            for artist in all_artists:
-                if artist.name == artist_name:
-                    matching_songs.append(song)
-                    break
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'duration': song.duration.total_seconds(),  # Convert DurationField to seconds
-                'tempo':  Tempo(song.tempo).label,
-                'mood':  Mood(song.mood).label,
-                'recorded_environment': RecordedEnvironment(song.recorded_environment).label,
-                'replay_count': song.replay_count,
-                'version': song.version,
-                'img_url': song.img_url
-            }
-            for song in matching_songs
-        ]
-        return JsonResponse({'songs': serialized_songs}, status=200)
-    except User.DoesNotExist:
-        return JsonResponse({'error': 'User does not exist'}, status=404)
-    except ValueError:
-        return JsonResponse({'error': 'Invalid number of songs'}, status=400)
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
-
+    genre_name: str = request.GET.get('genre_name')
+    if genre_name is None:  # if Genre Name is not provided
+        return HttpResponse(status=400)
+    return filtered_library_response(request, userid, genre_name=genre_name.title())
 
 
+@csrf_exempt
+@token_required
+def user_songs_with_artist(request, userid):
+    if request.method != 'GET':
+        return HttpResponse(status=405)
+    artist_name: str = request.GET.get('artist_name')
+    if artist_name is None:  # if Artist Name is not provided
+        return HttpResponse(status=400)
+    return filtered_library_response(request, userid, artist_name=artist_name.title())
 
 
 @csrf_exempt
@@ -485,44 +446,10 @@ def user_songs_with_artist(request, userid):
 def user_songs_with_tempo(request, userid):
     if request.method != 'GET':
         return HttpResponse(status=405)
-    try:
-        data = request.GET
-        number_of_songs: int = data.get('number_of_songs', 10)
-        number_of_songs = int(number_of_songs)
-        tempo_name: str = data.get('tempo_name')
-        if tempo_name is None:  # if Tempo Name is not provided
-            return HttpResponse(status=400)
-        tempo_name = tempo_name.capitalize()
-        user = User.objects.get(id=userid)
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').all()[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]  # Get the song objects from the ratings
-        matching_songs = []
-        for song in songs:
-            tempo_label = Tempo(song.tempo).label
-            if tempo_label == tempo_name:
-                matching_songs.append(song)
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'duration': song.duration.total_seconds(),  # Convert DurationField to seconds
-                'tempo': Tempo(song.tempo).label,
-                'mood': Mood(song.mood).label,
-                'recorded_environment': RecordedEnvironment(song.recorded_environment).label,
-                'replay_count': song.replay_count,
-                'version': song.version,
-                'img_url': song.img_url
-            }
-            for song in matching_songs
-        ]
-        return JsonResponse({'songs': serialized_songs}, status=200)
-    except User.DoesNotExist:
-        return JsonResponse({'error': 'User does not exist'}, status=404)
-    except ValueError:
-        return JsonResponse({'error': 'Invalid number of songs'}, status=400)
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+    tempo_name: str = request.GET.get('tempo_name')
+    if tempo_name is None:  # if Tempo Name is not provided
+        return HttpResponse(status=400)
+    return filtered_library_response(request, userid, tempo_name=tempo_name.capitalize())
 
 
 @csrf_exempt
@@ -530,44 +457,29 @@ def user_songs_with_tempo(request, userid):
 def user_songs_with_mood(request, userid):
     if request.method != 'GET':
         return HttpResponse(status=405)
-    try:
-        data = request.GET
-        number_of_songs: int = data.get('number_of_songs', 10)
-        number_of_songs = int(number_of_songs)
-        mood_name: str = data.get('mood_name')
-        if mood_name is None:  # if Mood Name is not provided
-            return HttpResponse(status=400)
-        mood_name = mood_name.capitalize()
-        user = User.objects.get(id=userid)
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').all()[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]  # Get the song objects from the ratings
-        matching_songs = []
-        for song in songs:
-            mood_label = Mood(song.mood).label
-            if mood_label == mood_name:
-                matching_songs.append(song)
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'duration': song.duration.total_seconds(),  # Convert DurationField to seconds
-                'tempo': Tempo(song.tempo).label,
-                'mood':  Mood(song.mood).label,
-                'recorded_environment': RecordedEnvironment(song.recorded_environment).label,
-                'replay_count': song.replay_count,
-                'version': song.version,
-                'img_url': song.img_url
-            }
-            for song in matching_songs
-        ]
-        return JsonResponse({'songs': serialized_songs}, status=200)
-    except User.DoesNotExist:
-        return JsonResponse({'error': 'User does not exist'}, status=404)
-    except ValueError:
-        return JsonResponse({'error': 'Invalid number of songs'}, status=400)
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+    mood_name: str = request.GET.get('mood_name')
+    if mood_name is None:  # if Mood Name is not provided
+        return HttpResponse(status=400)
+    return filtered_library_response(request, userid, mood_name=mood_name.capitalize())
+
+
+@csrf_exempt
+@token_required
+def user_songs_filtered(request, userid):
+    # Any combination of genre_name, artist_name, tempo_name and mood_name
+    if request.method != 'GET':
+        return HttpResponse(status=405)
+    data = request.GET
+    filters = {}
+    if data.get('genre_name') is not None:
+        filters['genre_name'] = data.get('genre_name').title()
+    if data.get('artist_name') is not None:
+        filters['artist_name'] = data.get('artist_name').title()
+    if data.get('tempo_name') is not None:
+        filters['tempo_name'] = data.get('tempo_name').capitalize()
+    if data.get('mood_name') is not None:
+        filters['mood_name'] = data.get('mood_name').capitalize()
+    return filtered_library_response(request, userid, **filters)
 
 
 @csrf_exempt
@@ -602,16 +514,7 @@ def get_recently_added_songs(request, userid):
             number_of_songs = int(number_of_songs)
             user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-created_at')[:number_of_songs]
         songs = [song_rating.song for song_rating in user_songs_ratings] # Get the song objects from the ratings
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'main_artist': song.artists.first().name if song.artists.exists() else "Unknown",
-                'img_url': song.img_url
-            }
-            for song in songs
-        ]
+        serialized_songs = serializeSongsMinimum(songs, default_artist="Unknown")
         return JsonResponse({'songs': serialized_songs}, status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
@@ -638,16 +541,7 @@ def get_favorite_songs(request, userid):
             user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating', '-updated_at')[:number_of_songs]
         songs = [song_rating.song for song_rating in user_songs_ratings]  # Get the song objects from the ratings
         # ratings = [song_rating.rating for song_rating in user_songs_ratings]  # In case we want to retrieve ratings
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'main_artist': song.artists.first().name if song.artists.exists() else "Unknown",
-                'img_url': song.img_url
-            }
-            for song in songs
-        ]
+        serialized_songs = serializeSongsMinimum(songs, default_artist="Unknown")
         return JsonResponse({'songs': serialized_songs},   status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
@@ -668,24 +562,12 @@ def get_favorite_genres(request, userid):
         limit = data.get('limit')
         if limit:
             limit = int(limit)
-        user = User.objects.get(id=userid)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        genre_counts = Counter()
-        for song in songs:
-            song_genre_table = song.genresong_set.prefetch_related('genre').all()
-            all_genres = [genre_song.genre for genre_song in song_genre_table]
-            for genre in all_genres:
-                genre_counts[genre.name] += 1
-        if not limit:
-            return JsonResponse(dict(genre_counts.most_common(10)), status=200)
-        else:
-            return JsonResponse(dict(genre_counts.most_common(limit)), status=200)
+        User.objects.get(id=userid)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        genre_counts = getTasteHistograms(userid, number_of_songs, facets=('genres',))['genres']
+        return JsonResponse(dict(genre_counts[:limit or 10]), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -705,23 +587,12 @@ def get_favorite_artists(request, userid):
         limit = data.get('limit')
         if limit:
             limit = int(limit)
-        user = User.objects.get(id=userid)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        artist_counts = Counter()
-        for song in songs:
-            song_artist_table = song.artistsong_set.prefetch_related('artist').all()
-            all_artists = [artist_song.artist for artist_song in song_artist_table]
-            for artist in all_artists:
-                artist_counts[artist.name] += 1
-        if not limit:
-            return JsonResponse(dict(artist_counts.most_common(10)), status=200)
-        else:
-            return JsonResponse(dict(artist_counts.most_common(limit)), status=200)
+        User.objects.get(id=userid)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        artist_counts = getTasteHistograms(userid, number_of_songs, facets=('artists',))['artists']
+        return JsonResponse(dict(artist_counts[:limit or 10]), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -738,19 +609,12 @@ def get_favorite_moods(request, userid):
     try:
         data = request.GET
         number_of_songs = data.get('number_of_songs')
-        user = User.objects.get(id=userid)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        mood_counts = Counter()
-        for song in songs:
-            mood_label = Mood(song.mood).label
-            mood_counts[mood_label] += 1
-
-        return JsonResponse(dict(mood_counts.most_common()), status=200)
+        User.objects.get(id=userid)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        mood_counts = getTasteHistograms(userid, number_of_songs, facets=('moods',))['moods']
+        return JsonResponse(dict(mood_counts), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -758,6 +622,7 @@ def get_favorite_moods(request, userid):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+
 @csrf_exempt
 @token_required
 def get_favorite_tempos(request, userid):
@@ -766,19 +631,12 @@ def get_favorite_tempos(request, userid):
     try:
         data = request.GET
         number_of_songs = data.get('number_of_songs')
-        user = User.objects.get(id=userid)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        tempo_counts = Counter()
-        for song in songs:
-            tempo_label = Tempo(song.tempo).label
-            tempo_counts[tempo_label] += 1
-
-        return JsonResponse(dict(tempo_counts.most_common()), status=200)
+        User.objects.get(id=userid)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        tempo_counts = getTasteHistograms(userid, number_of_songs, facets=('tempos',))['tempos']
+        return JsonResponse(dict(tempo_counts), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -813,16 +671,7 @@ def get_all_recent_songs(request, userid):
         number_of_songs: int = data.get('number_of_songs', 10)
         number_of_songs = int(number_of_songs)
         latest_songs = Song.objects.order_by('-created_at')[:number_of_songs]
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'release_year': song.release_year,
-                'main_artist': song.artists.first().name if song.artists.exists() else "Unknown",
-                'img_url': song.img_url
-            }
-            for song in latest_songs
-        ]
+        serialized_songs = serializeSongsMinimum(latest_songs, default_artist="Unknown")
         return JsonResponse({'songs': serialized_songs}, status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
@@ -1154,33 +1003,23 @@ def recommend_you_might_like(request, userid):
             if count is None or count < 1 or count > 100:
                 return JsonResponse({'error': 'Wrong parameter'}, status=400)
 
-            user_songs = UserSongRating.objects.filter(user=userid).order_by('-rating')[:20]
-
             # if user_songs.exists() is False:
             #     return JsonResponse({'error': 'No songs found for the user, cannot make recommendation'}, status=404)
 
             # client_credentials = SpotifyClientCredentials(client_id=os.getenv('SPOTIPY_CLIENT_ID'), client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'))
             # sp = spotipy.Spotify(client_credentials_manager=client_credentials)
 
-            track_list = []
-
-            for songs in user_songs:
-                track_list.append(songs.song.id)
-
-            list(set(track_list))
-
-            if len(track_list) > 5:
-                track_list = random.sample(track_list, 5)
-
-            params = {
-                'limit': count,
-                'seed_tracks': track_list
-            }
-            # spotify_recommendations = sp.recommendations(**params)
-            recommendations = get_recommendations(**params)
+            # Scored against the offline item neighbours, then the song
+            # features when they are built; the genre sampling of
+            # get_recommendations is the fallback. Songs the user rated are
+            # left out
+            context = RecommendationContext(userid)
+            context.load({'you_might_like'})
+            recommendations = youMightLikeIds(context, count)
 
-            if recommendations['items'] is None:
+            if recommendations['ids'] is None:
                 return JsonResponse({'error': 'No recommendations based on track can be made currently, please try again later'}, status=404)
+            recommendations = {'items': serializeSongsMinimum(recommendations['ids'], default_artist="Unknown")}
             # tracks_info = recommendation_creator(spotify_recommendations)
             return JsonResponse({'message': 'Recommendation based on track is successful', 'tracks_info': recommendations['items']}, status=200)
     except KeyError as e:
@@ -1280,77 +1119,15 @@ def recommend_since_you_like(request, userid):
             data = request.GET
             count = int(data.get('count'))
 
-            client_credentials = SpotifyClientCredentials(client_id=os.getenv('SPOTIPY_CLIENT_ID'), client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'))
-            sp = spotipy.Spotify(client_credentials_manager=client_credentials)
-
             if count is None or count < 1 or count > 100:
                 return JsonResponse({'error': 'Wrong parameter'}, status=404)
 
-            # global available_genre_seeds
-            # if available_genre_seeds is None:
-            #     available_genre_seeds = sp.recommendation_genre_seeds()['genres']
-
-            ratings = UserSongRating.objects.filter(user=userid).order_by('-rating')[:20]
-
-            user_genre_seeds = []
-            user_genre_seeds = getFavoriteGenres(userid,
-                                                 number_of_songs=20)
-            user_genre_seeds = [seed for seed, _ in user_genre_seeds]
-            # for rating in ratings:
-            #     song = Song.objects.get(id=rating.song.id)
-            #     for genre in song.genres.all():
-            #         user_genre_seeds.append(genre.name.lower())
-            # list(set(user_genre_seeds))
-
-            # user_genre_seeds = [seed for seed in user_genre_seeds if seed in available_genre_seeds]
-
-            if len(user_genre_seeds) < 2:
-                return JsonResponse({'error': 'No genre found for the user, cannot make recommendation'}, status=404)
-            user_genre_seeds = user_genre_seeds[:2]
-
-            artist_list = {}
-            artist_list = getFavoriteArtists(userid, number_of_songs=20)
-            artist_list = [name for name, _ in artist_list]
-            # for rating in ratings:
-            #     song = Song.objects.get(id=rating.song.id)
-            #     for artist in song.artists.all():
-            #         artist_list[artist.name] = artist.id
-
-            # if len(artist_list) > 2:
-            #     selected_artists = random.sample(artist_list.items(), 2)
-            #     artist_list = dict(selected_artists)
-
-            if len(artist_list) < 2:
-                return JsonResponse({'error': 'No artist found for the user, cannot make recommendation'}, status=404)
-            artist_list = artist_list[:2]
-
-            results = {}
-            
-            for genre in user_genre_seeds:
-                params = {
-                    'limit': count,
-                    'seed_genres': [genre]
-                }
-                # spotify_recommendations = sp.recommendations(**params)
-                recommendations = get_recommendations(**params)
-                if recommendations['items'] is None:
-                    return JsonResponse({'error': recommendations['error']}, status=404)
-                # results[genre] = recommendation_creator(spotify_recommendations)
-                results[genre.title()] = recommendations['items']
-
-            for artist_name in artist_list:
-                params = {
-                    'limit': count,
-                    'seed_artists': [artist_name]
-                }
-                # spotify_recommendations = sp.recommendations(**params)
-                recommendations = get_recommendations(**params)
-                if recommendations['items'] is None:
-                    return JsonResponse({'error': recommendations['error']}, status=404)
-                # results[artist] = recommendation_creator(spotify_recommendations)
-                results[artist_name.title()] = recommendations['items']
+            # Served from the per-user cache, stale sections are refreshed in the background
+            recommendations = cachedRecommendations(userid, 'since_you_like', count, getSinceYouLike)
+            if recommendations['items'] is None:
+                return JsonResponse({'error': recommendations['error']}, status=404)
 
-            return JsonResponse({'message': 'Recommendation based on what you listen is successful', 'tracks_info': results}, status=200)
+            return JsonResponse({'message': 'Recommendation based on what you listen is successful', 'tracks_info': recommendations['items']}, status=200)
     except KeyError as e:
         logging.error(f"A KeyError occurred: {str(e)}")
         return JsonResponse({'error': 'KeyError occurred'}, status=500)
@@ -1374,23 +1151,16 @@ def recommend_friend_mix(request, userid):
 
             try:
                 user = User.objects.get(id=userid)
-                friends_list = Friend.objects.filter(user=user)
-
-                available_friends = []
-                for friend in friends_list:
-                    if UserPreferences.objects.get(user=friend.friend).data_processing_consent is True:
-                        available_friends.append(friend)
+                available_friends = [friend['id'] for friend in getFriendsWithConsent(user.id)
+                                     if friend['data_processing_consent']]
 
                 if len(available_friends) < 1:
                     return JsonResponse({'error': 'No friends found for the user, cannot make recommendation'}, status=404)
                 
-                songs_seed = []
-                for friend in available_friends:
-                    friend_songs = UserSongRating.objects.filter(user=friend.friend).order_by('-rating')
-                    for song in friend_songs:
-                        songs_seed.append(song.song.id)
+                songs_seed = list(getTopRatings(available_friends, FRIEND_SAMPLE_SIZE)
+                                  .values_list('song_id', flat=True))
                         
-                list(set(songs_seed))
+                songs_seed = list(set(songs_seed))
 
                 if len(songs_seed) > 5:
                     songs_seed = random.sample(songs_seed, 5)
@@ -1400,7 +1170,8 @@ def recommend_friend_mix(request, userid):
                 
                 params = {
                     'limit': count,
-                    'seed_tracks': songs_seed
+                    'seed_tracks': songs_seed,
+                    'seen': SEEN_SONGS.get(userid)
                 }
 
                 # client_credentials = SpotifyClientCredentials(client_id=os.getenv('SPOTIPY_CLIENT_ID'), client_secret=os.getenv('SPOTIPY_CLIENT_SECRET'))
@@ -1436,13 +1207,8 @@ def recommend_friend_listen(request, userid):
             count = int(count)
             if count < 1:
                 return JsonResponse({'error': 'Invalid count'}, status=400)
-            friends = Friend.objects.filter(user=userid)
-
-            friends_list = []
-
-            for user in friends:
-                if UserPreferences.objects.get(user=user.friend).data_processing_consent is True:
-                    friends_list.append(user)
+            friends_list = [friend['id'] for friend in getFriendsWithConsent(userid)
+                            if friend['data_processing_consent']]
 
             if len(friends_list) < 1:
                     return JsonResponse({'error': 'No friends found for the user, cannot make recommendation'}, status=404)
@@ -1451,21 +1217,8 @@ def recommend_friend_listen(request, userid):
         
             if count > friend_count:
                 limit = count // friend_count
-            songs_list = []
-            
-            for friend in friends_list:
-                friend_songs = UserSongRating.objects.filter(user=friend.friend).order_by('-rating')[:10]    
-                for rating in friend_songs:
-                    song = Song.objects.get(id=rating.song.id)
-
-                    track_info = {
-                        'name': song.name,
-                        'main_artist': [artist.name for artist in song.artists.all()],
-                        'release_year': song.release_year,
-                        'id': song.id,
-                        'img_url': song.img_url,
-                    }
-                    songs_list.append(track_info)
+            song_ids = getTopRatings(friends_list, FRIEND_SAMPLE_SIZE).values_list('song_id', flat=True)
+            songs_list = [serializeFriendListenSong(song) for song in withSongRelations(list(song_ids), 'artists')]
             if len(songs_list) > count:
                 songs_list = random.sample(songs_list, count)
             elif len(songs_list) < 1:
@@ -1480,6 +1233,28 @@ def recommend_friend_listen(request, userid):
         return JsonResponse({'error': 'An unexpected error occurred'}, status=500)
 
 
+@csrf_exempt
+@token_required
+def recommend_batch(request, userid):
+    # Several recommendation sections in one call, e.g. for the home screen:
+    # {"sections": [{"type": "you_might_like", "count": 10},
+    #               {"type": "genres", "seeds": ["rock"], "count": 5, "name": "Rock"}]}
+    # The user's ratings and friends are read once for all sections
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=400)
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        sections = parseRecommendationSections(data.get('sections') if isinstance(data, dict) else None)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        return JsonResponse({'message': 'Batch recommendation is successful',
+                             'sections': getRecommendationBatch(userid, sections)}, status=200)
+    except Exception as e:
+        logging.error(f"An unexpected error occurred: {str(e)}")
+        return JsonResponse({'error': 'An unexpected error occurred'}, status=500)
+
+
 @csrf_exempt
 @token_required
 def export_by_genre(request, userid):
@@ -1499,25 +1274,7 @@ def export_by_genre(request, userid):
         ).order_by('-rating', '-updated_at').all()
 
         export_songs = [rating.filtered_songs for rating in user_songs_ratings if rating.filtered_songs]
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'genres': [genre.name for genre in song.genres.all()],
-                'artists': [artist.name for artist in song.artists.all()],
-                'albums': [album.name for album in song.albums.all()],
-                'instruments': [instrument.name for instrument in song.instruments.all()],
-                'release_year': song.release_year,
-                'duration': song.duration.total_seconds(),
-                'tempo': Tempo(song.tempo).label,
-                'mood': Mood(song.mood).label,
-                'recorded_environment': RecordedEnvironment(song.recorded_environment).label,
-                'replay_count': song.replay_count,
-                'version': song.version,
-                'img_url': song.img_url
-            }
-            for song in export_songs
-        ]
+        serialized_songs = serializeSongsExtended(export_songs)
         data_to_send = json.dumps(serialized_songs, indent=4, ensure_ascii=False)
         # Create a temporary file to write JSON data
         with tempfile.NamedTemporaryFile(delete=False, mode='w+', suffix='.json', encoding='utf-8') as tmp_file:
@@ -1565,25 +1322,7 @@ def export_by_artist(request, userid):
         ).order_by('-rating', '-updated_at').all()
 
         export_songs = [rating.filtered_songs for rating in user_songs_ratings if rating.filtered_songs]
-        serialized_songs = [
-            {
-                'id': song.id,
-                'name': song.name,
-                'genres': [genre.name for genre in song.genres.all()],
-                'artists': [artist.name for artist in song.artists.all()],
-                'albums': [album.name for album in song.albums.all()],
-                'instruments': [instrument.name for instrument in song.instruments.all()],
-                'release_year': song.release_year,
-                'duration': song.duration.total_seconds(),
-                'tempo': Tempo(song.tempo).label,
-                'mood': Mood(song.mood).label,
-                'recorded_environment': RecordedEnvironment(song.recorded_environment).label,
-                'replay_count': song.replay_count,
-                'version': song.version,
-                'img_url': song.img_url
-            }
-            for song in export_songs
-        ]
+        serialized_songs = serializeSongsExtended(export_songs)
         data_to_send = json.dumps(serialized_songs, indent=4, ensure_ascii=False)
         # Create a temporary file to write JSON data
         with tempfile.NamedTemporaryFile(delete=False, mode='w+', suffix='.json', encoding='utf-8') as tmp_file:
@@ -1718,14 +1457,11 @@ def get_library_artist_names(request, userid):
         return HttpResponse(status=405)
     try:
         user = User.objects.get(id=userid)
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').all()
-        artists = set()
-        for rating in user_songs_ratings:
-            song = rating.song
-            artists.update(artist.name for artist in song.artists.all())
+        artist_counts = getLibraryFacets(user.id)['artists']
+        artists = [name for name, count in artist_counts]
         if not artists:
             return JsonResponse({'error': 'No artist is found for the user'}, status=404)
-        return JsonResponse({'artists': list(artists)}, status=200)
+        return JsonResponse({'artists': artists, 'counts': dict(artist_counts)}, status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except Exception as e:
@@ -1739,14 +1475,11 @@ def get_library_genre_names(request, userid):
         return HttpResponse(status=405)
     try:
         user = User.objects.get(id=userid)
-        user_songs_ratings = user.usersongrating_set.prefetch_related('song').all()
-        genres = set()
-        for rating in user_songs_ratings:
-            song = rating.song
-            genres.update(genre.name for genre in song.genres.all())
+        genre_counts = getLibraryFacets(user.id)['genres']
+        genres = [name for name, count in genre_counts]
         if not genres:
             return JsonResponse({'error': 'No genre is found for the user'}, status=404)
-        return JsonResponse({'genres': list(genres)}, status=200)
+        return JsonResponse({'genres': genres, 'counts': dict(genre_counts)}, status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except Exception as e:
@@ -1761,14 +1494,14 @@ def get_all_data_sharing_friends(request, userid):
     # retrieve all users from database
     try:
         user = User.objects.get(id=userid)
-        friends = user.friends.all()
+        friends = getFriendsWithConsent(user.id)
         all_friends = [
             {
-                'id': friend.id,
-                'name': friend.username,
-                'img_url': friend.img_url
+                'id': friend['id'],
+                'name': friend['username'],
+                'img_url': friend['img_url']
             }
-            for friend in friends if friend.userpreferences.data_sharing_consent
+            for friend in friends if friend['data_sharing_consent']
         ]
         return JsonResponse({'friends': all_friends}, status=200)
     except Exception as e:
@@ -1791,22 +1524,11 @@ def get_friends_favorite_genres(request, userid):
         user_preferences = user.userpreferences
         if user_preferences.data_sharing_consent is False:
             return JsonResponse({'error': 'User does not share data'}, status=400)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        genre_counts = Counter()
-        for song in songs:
-            song_genre_table = song.genresong_set.prefetch_related('genre').all()
-            all_genres = [genre_song.genre for genre_song in song_genre_table]
-            for genre in all_genres:
-                genre_counts[genre.name] += 1
-        if not limit:
-            return JsonResponse(dict(genre_counts.most_common(10)), status=200)
-        else:
-            return JsonResponse(dict(genre_counts.most_common(limit)), status=200)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        genre_counts = getTasteHistograms(user.id, number_of_songs, facets=('genres',))['genres']
+        return JsonResponse(dict(genre_counts[:limit or 10]), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -1831,22 +1553,11 @@ def get_friends_favorite_artists(request, userid):
         user_preferences = user.userpreferences
         if user_preferences.data_sharing_consent is False:
             return JsonResponse({'error': 'User does not share data'}, status=400)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        artist_counts = Counter()
-        for song in songs:
-            song_artist_table = song.artistsong_set.prefetch_related('artist').all()
-            all_artists = [artist_song.artist for artist_song in song_artist_table]
-            for artist in all_artists:
-                artist_counts[artist.name] += 1
-        if not limit:
-            return JsonResponse(dict(artist_counts.most_common(10)), status=200)
-        else:
-            return JsonResponse(dict(artist_counts.most_common(limit)), status=200)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        artist_counts = getTasteHistograms(user.id, number_of_songs, facets=('artists',))['artists']
+        return JsonResponse(dict(artist_counts[:limit or 10]), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -1868,17 +1579,11 @@ def get_friends_favorite_moods(request, userid):
         user_preferences = user.userpreferences
         if user_preferences.data_sharing_consent is False:
             return JsonResponse({'error': 'User does not share data'}, status=400)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        mood_counts = Counter()
-        for song in songs:
-            mood_label = Mood(song.mood).label
-            mood_counts[mood_label] += 1
-        return JsonResponse(dict(mood_counts.most_common()), status=200)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        mood_counts = getTasteHistograms(user.id, number_of_songs, facets=('moods',))['moods']
+        return JsonResponse(dict(mood_counts), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -1900,17 +1605,11 @@ def get_friends_favorite_tempos(request, userid):
         user_preferences = user.userpreferences
         if user_preferences.data_sharing_consent is False:
             return JsonResponse({'error': 'User does not share data'}, status=400)
-        if number_of_songs is None:
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating').all()
-        else:
-            number_of_songs = int(number_of_songs)
-            user_songs_ratings = user.usersongrating_set.prefetch_related('song').order_by('-rating')[:number_of_songs]
-        songs = [song_rating.song for song_rating in user_songs_ratings]
-        tempo_counts = Counter()
-        for song in songs:
-            tempo_label = Tempo(song.tempo).label
-            tempo_counts[tempo_label] += 1
-        return JsonResponse(dict(tempo_counts.most_common()), status=200)
+        number_of_songs = -1 if number_of_songs is None else int(number_of_songs)
+        if number_of_songs < -1:
+            raise ValueError
+        tempo_counts = getTasteHistograms(user.id, number_of_songs, facets=('tempos',))['tempos']
+        return JsonResponse(dict(tempo_counts), status=200)
     except User.DoesNotExist:
         return JsonResponse({'error': 'User does not exist'}, status=404)
     except ValueError:
@@ -1968,15 +1667,8 @@ def get_playlists(request, userid):
         if user is None:
             return JsonResponse({'error': 'User does not exist'}, status=404)
 
-        playlists = user.playlists.order_by('-updated_at').all()
-
-        if len(playlists) > count:
-            playlists = playlists[:count]
-
-        data = []
-        for playlist in playlists:
-            serialized_pl = serializePlaylistInfo(playlist)
-            data.append(serialized_pl)
+        playlists = user.playlists.order_by('-updated_at')[:count]
+        data = serializePlaylistsInfo(playlists)
         return JsonResponse({'items': data, 'count': len(data)}, status=200)
     except Exception as e:
         return JsonResponse({'Unexpected error': str(e)}, status=500)
@@ -2389,10 +2081,7 @@ def get_playlists_of_group(request, userid):
             return JsonResponse({'error': 'Please check the group id field.'}, status=400)
         friend_group = FriendGroup.objects.get(id=group_id)
         playlists = friend_group.playlists.order_by('-updated_at').all()
-        data = []
-        for playlist in playlists:
-            serialized_pl = serializePlaylistInfo(playlist)
-            data.append(serialized_pl)
+        data = serializePlaylistsInfo(playlists)
         return JsonResponse({'items': data, 'count': len(data)}, status=200)
         #return JsonResponse({'playlists': serialized_playlists}, status=200)
     except ValueError:
@@ -2516,19 +2205,19 @@ def get_suggestions(request, userid):
                 user = User.objects.get(id=userid)
             except User.DoesNotExist:
                 return JsonResponse({'error': 'User not found'}, status=404)
-            notifications = SuggestionNotification.objects.filter(receiver=user)
-
-            serialized_notifications = []
-            for notification in notifications:
-                serialized_notifications.append({
-                    'id': notification.id,
-                    'suggester_name': notification.suggester.username,
-                    'suggester_img_url': User.objects.get(username=notification.suggester.username).img_url, #notification.receiver.username,
-                    'song_id': notification.song.id,  # Replace with the appropriate field for the song name
-                    'song_img_url': notification.song.img_url,
-                    'song_name': notification.song.name
-                })
-            return JsonResponse({'items': serialized_notifications}, status=200)
+            try:
+                number_of_suggestions = int(request.GET.get('number_of_suggestions', 20))
+                if number_of_suggestions < 1:
+                    raise ValueError('Invalid number of suggestions')
+                notifications, next_cursor = getSuggestionInbox(user, number_of_suggestions,
+                                                                request.GET.get('cursor'))
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            unread_count = SuggestionNotification.objects.filter(receiver=user, is_seen=False).count()
+            serialized_notifications = [serializeSuggestion(notification) for notification in notifications]
+            return JsonResponse({'items': serialized_notifications,
+                                 'next_cursor': next_cursor,
+                                 'unread_count': unread_count}, status=200)
     except KeyError as e:
         logging.error(f"A KeyError occurred: {str(e)}")
         return JsonResponse({'error': str(e)}, status=500)